@@ -50,6 +50,10 @@ setup(
         "python-dateutil",
         "PyYAML",
     ],
+    extras_require={
+        "msgpack": ["msgpack >=0.5.2"],
+        "orjson": ["orjson"],
+    },
     entry_points={
         'console_scripts': [
             'sun = sunhead.__main__:main',
@@ -0,0 +1,49 @@
+"""
+
+"""
+
+
+import argparse
+
+from sunhead.cli.abc import Command
+from sunhead.workers.supervisor import Supervisor
+
+
+class Runworkers(Command):
+    """
+    Start several stream worker processes
+    """
+
+    def handler(self, options) -> None:
+        supervisor = Supervisor(
+            options["worker_class"],
+            processes=options["processes"],
+            metrics_dir=options["metrics_dir"],
+            metrics_interval_secs=options["metrics_interval"],
+        )
+        supervisor.run()
+
+    def get_parser(self):
+        parser_command = argparse.ArgumentParser(description="Run stream worker processes")
+        parser_command.add_argument(
+            "worker_class",
+            help="Dotted path to the StreamWorker subclass, e.g. myapp.workers.Worker",
+        )
+        parser_command.add_argument(
+            "-n", "--processes",
+            type=int,
+            help="Number of worker processes. Number of CPUs by default",
+        )
+        parser_command.add_argument(
+            "--metrics-dir",
+            dest="metrics_dir",
+            help="Directory to write merged metrics of all workers to",
+        )
+        parser_command.add_argument(
+            "--metrics-interval",
+            dest="metrics_interval",
+            type=int,
+            default=Supervisor.DEFAULT_METRICS_INTERVAL_SECS,
+            help="How often metrics are written, in seconds",
+        )
+        return parser_command
@@ -7,11 +7,13 @@ from typing import Optional, Iterable
 from sunhead.conf import settings
 from sunhead.cli.abc import Command
 from sunhead.cli.commands.runserver import Runserver
+from sunhead.cli.commands.runworkers import Runworkers
 from sunhead.cli.helpers import parse_args, run_command
 
 
 default_commands = (
     Runserver(),
+    Runworkers(),
 )
 
 default_fallback = "sunhead.global_settings"
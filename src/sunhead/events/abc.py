@@ -3,7 +3,7 @@ Abstract and bases for building messaging stuff.
 """
 
 from abc import ABCMeta, abstractmethod, ABC, abstractproperty
-from typing import AnyStr, Sequence
+from typing import AnyStr, Callable, Optional, Sequence, Tuple
 
 from sunhead.events.types import Transferrable, Serialized
 
@@ -23,10 +23,32 @@ class SingleConnectionMeta(ABC):
 
 class AbstractSubscriber(object, metaclass=ABCMeta):
 
+    # How many messages this subscriber may handle simultaneously. ``None`` for transport default.
+    MAX_IN_FLIGHT = None
+
+    # Receive ``sunhead.events.message.Message`` (or ``LazyBody``) instead of deserialized data
+    RAW_DELIVERY = False
+
+    # Receive up to that many messages at once through ``on_batch``. ``None`` to receive them one by one.
+    BATCH_SIZE = None
+    BATCH_LINGER_SECS = 0.05
+
     @abstractmethod
     async def on_message(self, data: Transferrable, topic: AnyStr):
+        """
+        Handle message. When message is an RPC request, returned value is sent back as a reply.
+        """
         pass
 
+    async def on_batch(self, messages: Sequence[Tuple[Transferrable, AnyStr]]):
+        """
+        Handle batch of ``(data, topic)`` pairs. Used instead of ``on_message`` when ``BATCH_SIZE`` is set.
+
+        Raise ``sunhead.events.exceptions.PartialBatchError`` to reject only some messages of the batch.
+        Any other exception rejects the whole batch.
+        """
+        raise NotImplementedError
+
     @property
     @abstractmethod
     def name(self):
@@ -59,16 +81,47 @@ class AbstractTransport(SingleConnectionMeta):
         pass
 
     @abstractmethod
-    async def publish(self, data: Transferrable, topic: AnyStr) -> None:
+    async def publish(self, data: Transferrable, topic: AnyStr, **kwargs) -> None:
+        """
+        :param kwargs: Transport-specific options, e.g. ``key`` or ``trace_id``. Transports must ignore
+            options they don't know, so the same call works with any of them.
+        """
         pass
 
+    async def publish_many(self, data: Transferrable, topics: Sequence[AnyStr], **kwargs) -> None:
+        """
+        Publish the same message with several topics. Transports should override it to serialize message once.
+        """
+        for topic in topics:
+            await self.publish(data, topic, **kwargs)
+
     @abstractmethod
     async def consume_queue(self, subscriber: AbstractSubscriber) -> None:
         pass
 
+    async def call(self, data: Transferrable, topic: AnyStr, timeout: Optional[float] = None) -> Transferrable:
+        """
+        Publish request and wait for the reply, which is the return value of its subscriber's ``on_message``.
+        """
+        raise NotImplementedError("Transport '%s' doesn't support RPC" % self.__class__.__name__)
+
+    def set_disconnect_callback(self, callback: Callable) -> None:
+        """
+        Callback is called without arguments, when transport detects that connection is lost.
+        """
+        self._disconnect_callback = callback
+
+    def _notify_disconnected(self) -> None:
+        callback = getattr(self, "_disconnect_callback", None)
+        if callback is not None:
+            callback()
+
 
 class AbstractSerializer(object, metaclass=ABCMeta):
 
+    # Messages and responses are marked with it, so the other side knows how to deserialize them
+    CONTENT_TYPE = None
+
     @abstractmethod
     def __init__(self, *args, **kwargs):
         pass
@@ -91,6 +144,13 @@ class AbstractSerializer(object, metaclass=ABCMeta):
     def serialize(self, data: Transferrable) -> Serialized:
         pass
 
+    def serialize_bytes(self, data: Transferrable, **kwargs) -> bytes:
+        """
+        Serialize straight to UTF-8 bytes, ready to be sent. Override, if serializer can produce them directly.
+        """
+        serialized = self.serialize(data, **kwargs)
+        return serialized.encode("utf-8") if isinstance(serialized, str) else serialized
+
     @abstractmethod
     def deserialize(self, msg: Serialized) -> Transferrable:
         pass
\ No newline at end of file
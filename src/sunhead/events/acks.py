@@ -0,0 +1,118 @@
+"""
+Coalescing of message acknowledgements.
+
+Instead of sending ``basic.ack`` per message, completed delivery tags are collected and acknowledged
+with a single ``multiple=True`` frame for the highest tag, below which everything is completed.
+Flush happens when enough acks are collected or by timer.
+
+Delivery tags are per channel, so there must be one coalescer per consuming channel.
+Negative acknowledgements are sent right away and only for the particular tag. Tags completed out of
+order wait for the gap to be filled, unless there are too many of them, then they are acked one by one.
+"""
+
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("AckCoalescer", )
+
+
+class AckCoalescer(object):
+
+    DEFAULT_MAX_PENDING = 50
+    DEFAULT_FLUSH_SECS = 0.1
+
+    def __init__(self, channel, max_pending: int = DEFAULT_MAX_PENDING, flush_secs: float = DEFAULT_FLUSH_SECS):
+        """
+        :param channel: Consuming channel, whose deliveries are acknowledged.
+        :param max_pending: Flush when that many acks are waiting.
+        :param flush_secs: Flush acks not later than that.
+        """
+        self._channel = channel
+        self._max_pending = max_pending
+        self._flush_secs = flush_secs
+
+        # Every tag up to the watermark is settled locally. Everything up to the ``_flushed`` is settled in broker.
+        self._watermark = 0
+        self._flushed = 0
+        self._last_contiguous_ack = 0
+        self._unflushed_count = 0
+
+        # Tags above the watermark: completed but not sent yet, and already settled in broker one by one
+        self._completed = set()
+        self._sent = set()
+
+        self._flush_handle = None
+
+    @property
+    def channel(self):
+        return self._channel
+
+    @property
+    def pending(self) -> int:
+        return self._unflushed_count + len(self._completed)
+
+    async def ack(self, delivery_tag: int) -> None:
+        self._completed.add(delivery_tag)
+        self._advance()
+
+        if self._unflushed_count + len(self._completed) >= self._max_pending:
+            await self.flush()
+        else:
+            self._schedule_flush()
+
+    async def nack(self, delivery_tag: int, requeue: bool = False) -> None:
+        self._sent.add(delivery_tag)
+        self._advance()
+        await self._channel.basic_client_nack(delivery_tag, multiple=False, requeue=requeue)
+        if self._unflushed_count:
+            self._schedule_flush()
+
+    async def flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        if self._last_contiguous_ack > self._flushed:
+            tag = self._last_contiguous_ack
+            self._flushed = self._watermark
+            self._unflushed_count = 0
+            await self._channel.basic_client_ack(tag, multiple=True)
+
+        if len(self._completed) >= self._max_pending:
+            # Something holds the watermark for too long. Don't keep prefetch window occupied because of it.
+            stragglers = sorted(self._completed)
+            self._completed.clear()
+            self._sent.update(stragglers)
+            for tag in stragglers:
+                await self._channel.basic_client_ack(tag)
+
+    def _advance(self) -> None:
+        while True:
+            tag = self._watermark + 1
+            if tag in self._completed:
+                self._completed.remove(tag)
+                self._last_contiguous_ack = tag
+                self._unflushed_count += 1
+            elif tag in self._sent:
+                self._sent.remove(tag)
+            else:
+                break
+            self._watermark = tag
+
+    def _schedule_flush(self) -> None:
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_later(self._flush_secs, self._flush_by_timer)
+
+    def _flush_by_timer(self) -> None:
+        self._flush_handle = None
+        asyncio.ensure_future(self._safe_flush())
+
+    async def _safe_flush(self) -> None:
+        try:
+            await self.flush()
+        except Exception:
+            logger.error("Can't flush acknowledgements", exc_info=True)
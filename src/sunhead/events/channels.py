@@ -0,0 +1,185 @@
+"""
+Pool of AMQP channels on a single connection.
+
+Publishing and consuming are done through the separate channels, so heavy consuming does not delay
+publishes and channel error in one of them does not stop all the traffic. Publishes are spread
+round-robin over several channels. Closed channels are reopened on demand, except the consume channel,
+which is reopened as soon as broker closes it, because nothing else would ask for it to restore consumers.
+"""
+
+import asyncio
+from functools import partial
+from itertools import count
+import logging
+from typing import Callable, Optional
+
+from aioamqp.exceptions import PublishFailed
+from aioamqp.frame import AmqpDecoder
+
+from sunhead.events import exceptions
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("ChannelPool", "track_multiple_confirms")
+
+
+_CONFIRM_WAITER_PREFIX = "basic_server_ack_"
+
+
+def track_multiple_confirms(channel) -> None:
+    """
+    Make channel in confirm mode resolve every publish, covered by the broker's ack or nack.
+
+    Broker confirms many messages at once with ``multiple`` flag, especially under load. aioamqp ignores
+    the flag and resolves only the message with the given delivery tag, so the lower ones are never confirmed.
+    """
+    channel.basic_server_ack = partial(_on_server_confirm, channel, True)
+    channel.basic_server_nack = partial(_on_server_confirm, channel, False)
+
+
+async def _on_server_confirm(channel, acked: bool, frame) -> None:
+    decoder = AmqpDecoder(frame.payload)
+    delivery_tag = decoder.read_long_long()
+    # ``multiple`` is the lowest bit for both ack and nack
+    multiple = bool(decoder.read_octet() & 1)
+
+    # aioamqp keeps confirm waiters only in its private dict, there is no other way to find the covered ones
+    for name in list(channel._futures):
+        if not name.startswith(_CONFIRM_WAITER_PREFIX):
+            continue
+        tag = int(name[len(_CONFIRM_WAITER_PREFIX):])
+        if tag != delivery_tag and not (multiple and tag < delivery_tag):
+            continue
+
+        waiter = channel._futures.pop(name)
+        if waiter.done():
+            continue
+        if acked:
+            waiter.set_result(True)
+        else:
+            waiter.set_exception(PublishFailed(tag))
+
+
+class ChannelPool(object):
+
+    PURPOSE_PUBLISH = "publish"
+    PURPOSE_CONSUME = "consume"
+    PURPOSE_REPLY = "reply"
+
+    DEFAULT_PUBLISH_CHANNELS = 1
+
+    def __init__(self, protocol, publish_channels: int = DEFAULT_PUBLISH_CHANNELS, on_open: Optional[Callable] = None):
+        """
+        :param protocol: Connected ``aioamqp`` protocol.
+        :param publish_channels: How many channels to use for publishing.
+        :param on_open: Coroutine function ``on_open(channel, purpose)``, called for every opened channel.
+        """
+        self._protocol = protocol
+        self._on_open = on_open
+        self._publish_channels = [None] * max(publish_channels, 1)
+        self._consume_channel = None
+        self._reply_channel = None
+        self._counter = count()
+        self._lock = asyncio.Lock()
+        self._abandoned = False
+        self._consume_lost = False
+        self._consume_watcher = None
+
+    @property
+    def is_open(self) -> bool:
+        if self._consume_lost:
+            # Without consume channel client is useless, even if it still can publish
+            return False
+        return any(channel is not None and channel.is_open for channel in self._all_channels())
+
+    async def open(self) -> None:
+        await self.get_consume_channel()
+        for idx in range(len(self._publish_channels)):
+            await self._get_publish_channel(idx)
+
+    async def close(self) -> None:
+        self.abandon()
+        for channel in self._all_channels():
+            if channel is not None and channel.is_open:
+                await channel.close()
+
+    async def get_publish_channel(self):
+        idx = next(self._counter) % len(self._publish_channels)
+        return await self._get_publish_channel(idx)
+
+    async def get_consume_channel(self):
+        channel = self._consume_channel
+        if channel is not None and channel.is_open:
+            return channel
+
+        async with self._lock:
+            if self._consume_channel is None or not self._consume_channel.is_open:
+                if self._consume_channel is not None:
+                    logger.warning("Consume channel was closed, reopening")
+                self._consume_channel = await self._open_channel(self.PURPOSE_CONSUME)
+                self._consume_watcher = asyncio.ensure_future(self._reopen_when_closed(self._consume_channel))
+        return self._consume_channel
+
+    def abandon(self) -> None:
+        """
+        Connection is lost, so don't try to reopen channels anymore.
+        """
+        self._abandoned = True
+        if self._consume_watcher is not None:
+            self._consume_watcher.cancel()
+
+    async def _reopen_when_closed(self, channel) -> None:
+        await channel.close_event.wait()
+        if self._abandoned or channel is not self._consume_channel:
+            return
+
+        try:
+            await self.get_consume_channel()
+        except exceptions.StreamConnectionError:
+            logger.error("Consume channel is lost, connection must be reestablished")
+            self._consume_lost = True
+
+    async def get_reply_channel(self):
+        """
+        Channel for RPC replies. Opened on first use, so clients without RPC calls don't have it.
+        """
+        channel = self._reply_channel
+        if channel is not None and channel.is_open:
+            return channel
+
+        async with self._lock:
+            if self._reply_channel is None or not self._reply_channel.is_open:
+                if self._reply_channel is not None:
+                    logger.warning("Reply channel was closed, reopening")
+                self._reply_channel = await self._open_channel(self.PURPOSE_REPLY)
+        return self._reply_channel
+
+    async def _get_publish_channel(self, idx: int):
+        channel = self._publish_channels[idx]
+        if channel is not None and channel.is_open:
+            return channel
+
+        async with self._lock:
+            channel = self._publish_channels[idx]
+            if channel is None or not channel.is_open:
+                if channel is not None:
+                    logger.warning("Publish channel #%s was closed, reopening", idx)
+                channel = await self._open_channel(self.PURPOSE_PUBLISH)
+                self._publish_channels[idx] = channel
+        return channel
+
+    async def _open_channel(self, purpose: str):
+        try:
+            channel = await self._protocol.channel()
+            if self._on_open is not None:
+                await self._on_open(channel, purpose)
+        except Exception:
+            logger.error("Can't open %s channel", purpose, exc_info=True)
+            raise exceptions.StreamConnectionError
+        logger.debug("Opened %s channel #%s", purpose, channel.channel_id)
+        return channel
+
+    def _all_channels(self):
+        return [self._consume_channel, self._reply_channel] + self._publish_channels
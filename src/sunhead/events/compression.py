@@ -0,0 +1,98 @@
+"""
+Message body compression.
+
+Bodies bigger than the threshold are compressed with the chosen codec. Codec name travels with the message
+(AMQP ``content_encoding`` property), so consumer knows how to decompress it, whatever its own settings are.
+``deflate`` (zlib) and ``lzma`` codecs are available out of the box, more can be added with ``register_codec``.
+"""
+
+import logging
+import lzma
+from typing import Callable, Optional, Tuple
+import zlib
+
+from sunhead.events.exceptions import SerializationError
+from sunhead.events.metrics import get_stream_metrics, COMPRESSION_RATIO
+from sunhead.events.types import Serialized
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("Compressor", "register_codec", "decompress")
+
+
+_codecs = {}
+
+
+def register_codec(name: str, compress: Callable, decompress: Callable) -> None:
+    """
+    Make codec available for compression and decompression.
+
+    :param name: Name of the codec, sent as message content encoding.
+    :param compress: Function ``compress(data: bytes) -> bytes``.
+    :param decompress: Function ``decompress(data: bytes) -> bytes``.
+    """
+    _codecs[name] = (compress, decompress)
+
+
+register_codec("deflate", zlib.compress, zlib.decompress)
+register_codec("lzma", lzma.compress, lzma.decompress)
+
+
+def decompress(body: bytes, encoding: Optional[str]) -> bytes:
+    """
+    Decompress body of the message with given content encoding. Body without encoding is returned as is.
+    """
+    if not encoding:
+        return body
+
+    if encoding not in _codecs:
+        raise SerializationError("Unknown content encoding '%s'" % encoding)
+
+    try:
+        return _codecs[encoding][1](body)
+    except Exception as e:
+        raise SerializationError("Can't decompress message body with '%s': %r" % (encoding, e))
+
+
+class Compressor(object):
+
+    DEFAULT_CODEC = "deflate"
+    DEFAULT_THRESHOLD = 1024
+
+    def __init__(self, codec: str = DEFAULT_CODEC, threshold: int = DEFAULT_THRESHOLD):
+        """
+        :param codec: Name of the registered codec.
+        :param threshold: Compress only bodies of that many bytes or bigger.
+        """
+        if codec not in _codecs:
+            raise ValueError("Unknown compression codec '%s'" % codec)
+
+        self._codec = codec
+        self._compress = _codecs[codec][0]
+        self._threshold = threshold
+
+        metrics = get_stream_metrics()
+        self._ratio_summary = metrics.summaries[metrics.prefix(COMPRESSION_RATIO)].labels(codec)
+
+    @property
+    def codec(self) -> str:
+        return self._codec
+
+    def compress(self, body: Serialized) -> Tuple[Serialized, Optional[str]]:
+        """
+        Compress body, if it is worth it.
+
+        :return: Tuple of body and its content encoding. Encoding is None, when body is left uncompressed.
+        """
+        if len(body) < self._threshold:
+            return body, None
+
+        data = body.encode("utf-8") if isinstance(body, str) else body
+        compressed = self._compress(data)
+        if len(compressed) >= len(data):
+            return body, None
+
+        self._ratio_summary.observe(len(data) / len(compressed))
+        return compressed, self._codec
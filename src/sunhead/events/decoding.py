@@ -0,0 +1,114 @@
+"""
+Deserialization of large message bodies off the event loop.
+
+Small bodies are cheap to decode, so they are left to ``LazyBody`` as usual. Bodies above the threshold
+are decoded in a thread or process pool, so a few big messages don't stall everything else on the loop.
+Compressed bodies are decompressed by the same pool job.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import Executor, ProcessPoolExecutor
+from functools import partial
+from typing import Optional, Tuple
+
+from sunhead.events.abc import AbstractSerializer
+from sunhead.events.compression import decompress
+from sunhead.events.message import LazyBody
+from sunhead.events.metrics import get_stream_metrics, DECODE_PENDING, DECODE_LATENCY
+from sunhead.events.types import Serialized, Transferrable
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("OffloadDecoder", )
+
+
+_process_serializers = {}
+
+
+def _decode(
+        serializer: AbstractSerializer,
+        encoding: Optional[str],
+        raw: Serialized,
+        deserialize: bool) -> Tuple[Serialized, Optional[Transferrable]]:
+    raw = decompress(raw, encoding)
+    data = serializer.deserialize(raw) if deserialize else None
+    return raw, data
+
+
+def _decode_in_process(
+        content_type: str,
+        encoding: Optional[str],
+        raw: Serialized,
+        deserialize: bool) -> Tuple[Serialized, Optional[Transferrable]]:
+    # Serializer instances are not always picklable, so worker process makes its own one
+    from sunhead.serializers import get_serializer
+
+    serializer = _process_serializers.get(content_type)
+    if serializer is None:
+        serializer = get_serializer(content_type)
+        _process_serializers[content_type] = serializer
+    return _decode(serializer, encoding, raw, deserialize)
+
+
+class OffloadDecoder(object):
+
+    DEFAULT_THRESHOLD = 1024 * 1024
+
+    def __init__(self, executor: Executor, threshold: int = DEFAULT_THRESHOLD):
+        """
+        :param executor: Pool to decode bodies in. See ``sunhead.utils.make_executor``.
+        :param threshold: Decode bodies of that many bytes or bigger in the pool.
+        """
+        self._executor = executor
+        self._threshold = threshold
+        self._in_process = isinstance(executor, ProcessPoolExecutor)
+
+        metrics = get_stream_metrics()
+        self._pending_gauge = metrics.gauges[metrics.prefix(DECODE_PENDING)]
+        self._latency_summary = metrics.summaries[metrics.prefix(DECODE_LATENCY)]
+
+    def should_offload(self, size: int) -> bool:
+        """
+        :param size: Size of the body. For compressed one, the bigger of compressed and declared original size.
+        """
+        return size >= self._threshold
+
+    async def decode(
+            self,
+            body: LazyBody,
+            serializer: AbstractSerializer,
+            encoding: Optional[str] = None,
+            deserialize: bool = True) -> LazyBody:
+        """
+        Decompress and deserialize body in the pool.
+
+        :param body: Body, compressed with ``encoding``, if it is given.
+        :param deserialize: Only decompress, when nobody needs the data.
+        :return: Decompressed body, with data already set, if it was deserialized.
+        """
+        loop = asyncio.get_event_loop()
+        # Underlying bytes object is taken to avoid copying the body before it is pickled
+        raw = body.raw.obj
+        if self._in_process:
+            job = partial(_decode_in_process, serializer.CONTENT_TYPE, encoding, raw, deserialize)
+        else:
+            job = partial(_decode, serializer, encoding, raw, deserialize)
+
+        started_at = loop.time()
+        self._pending_gauge.inc()
+        try:
+            raw, data = await loop.run_in_executor(self._executor, job)
+        finally:
+            self._pending_gauge.dec()
+            self._latency_summary.observe(loop.time() - started_at)
+
+        decoded = LazyBody(raw, serializer) if encoding else body
+        if deserialize:
+            decoded.set_data(data)
+        return decoded
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
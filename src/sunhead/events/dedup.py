@@ -0,0 +1,204 @@
+"""
+Skipping messages, which were already handled, e.g. redelivered by broker after reconnect.
+
+Message is identified by its ``message_id`` property or, when there is none, by the hash of its body.
+Handled ids are kept in memory in LRU order for a limited time. Optionally they are also written to
+the on-disk index, a fixed-size hash table in a mmap file, so the process remembers them after restart.
+"""
+
+from collections import OrderedDict
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import AnyStr, Optional
+
+from sunhead.events.metrics import get_stream_metrics, DEDUP_HITS, DEDUP_MISSES
+from sunhead.events.types import Serialized
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("DedupCache", "DedupIndex")
+
+
+KEY_SIZE = 16
+
+# blake2b is fast and allows short digests, but is missing in older Pythons
+_hash = getattr(hashlib, "blake2b", None)
+if _hash is not None:
+    def _digest(*parts: bytes) -> bytes:
+        digest = _hash(digest_size=KEY_SIZE)
+        for part in parts:
+            digest.update(part)
+        return digest.digest()
+else:
+    def _digest(*parts: bytes) -> bytes:
+        digest = hashlib.md5()
+        for part in parts:
+            digest.update(part)
+        return digest.digest()
+
+
+class DedupIndex(object):
+    """
+    Open addressing hash table of ``(key, expires_at)`` slots in a mmap file. When all probed slots are taken,
+    the one, which expires first, is overwritten, so index never grows and old keys are forgotten first.
+    """
+
+    DEFAULT_SLOTS = 1024 * 1024
+    PROBES = 8
+
+    _SLOT = struct.Struct(">{}sd".format(KEY_SIZE))
+    _EMPTY_KEY = bytes(KEY_SIZE)
+
+    def __init__(self, path: str, slots: int = DEFAULT_SLOTS):
+        """
+        :param path: Index file. Created if missing.
+        :param slots: Capacity of the index. Ignored, if file already exists.
+        """
+        self._path = path
+        if not os.path.exists(path) or not os.path.getsize(path):
+            with open(path, "wb") as f:
+                f.truncate(slots * self._SLOT.size)
+        self._file = open(path, "r+b")
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._slots = len(self._mmap) // self._SLOT.size
+
+    def get(self, key: bytes) -> Optional[float]:
+        """
+        :return: Expiration time of the key, None if it is not in the index.
+        """
+        for offset in self._probe(key):
+            slot_key, expires_at = self._SLOT.unpack_from(self._mmap, offset)
+            if slot_key == key:
+                return expires_at
+            if slot_key == self._EMPTY_KEY:
+                return None
+        return None
+
+    def add(self, key: bytes, expires_at: float) -> None:
+        victim, victim_expires_at = None, None
+        for offset in self._probe(key):
+            slot_key, slot_expires_at = self._SLOT.unpack_from(self._mmap, offset)
+            if slot_key == key or slot_key == self._EMPTY_KEY:
+                victim = offset
+                break
+            if victim is None or slot_expires_at < victim_expires_at:
+                victim, victim_expires_at = offset, slot_expires_at
+        self._SLOT.pack_into(self._mmap, victim, key, expires_at)
+
+    def close(self) -> None:
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.close()
+
+    def _probe(self, key: bytes):
+        start = int.from_bytes(key[:8], "big") % self._slots
+        for idx in range(min(self.PROBES, self._slots)):
+            yield ((start + idx) % self._slots) * self._SLOT.size
+
+
+class DedupCache(object):
+
+    DEFAULT_MAX_SIZE = 100000
+    DEFAULT_TTL_SECS = 3600
+
+    def __init__(
+            self,
+            max_size: int = DEFAULT_MAX_SIZE,
+            ttl_secs: float = DEFAULT_TTL_SECS,
+            index_path: Optional[str] = None,
+            index_slots: int = DedupIndex.DEFAULT_SLOTS):
+        """
+        :param max_size: How many handled message ids to keep in memory.
+        :param ttl_secs: How long to remember handled message.
+        :param index_path: File of the on-disk index. Only memory is used if omitted.
+        :param index_slots: Capacity of the on-disk index.
+        """
+        self._max_size = max_size
+        self._ttl_secs = ttl_secs
+        self._handled = OrderedDict()
+        self._claimed = set()
+        self._index = DedupIndex(index_path, slots=index_slots) if index_path else None
+
+        metrics = get_stream_metrics()
+        self._hits_counter = metrics.counters[metrics.prefix(DEDUP_HITS)]
+        self._misses_counter = metrics.counters[metrics.prefix(DEDUP_MISSES)]
+
+    def get_key(
+            self,
+            message_id: Optional[str],
+            body: Serialized,
+            routing_key: AnyStr = "",
+            consumer: str = "") -> bytes:
+        """
+        Message is identified by ``message_id`` or by its body, if it has none. The same message,
+        delivered with another routing key or to another consumer, is not a duplicate.
+
+        :param consumer: Who handles the message, e.g. queue or subscriber names.
+        """
+        identity = message_id or body
+        scope = "{}\0{}\0".format(
+            consumer, routing_key.decode("utf-8") if isinstance(routing_key, bytes) else routing_key)
+        return _digest(scope.encode("utf-8"), identity.encode("utf-8") if isinstance(identity, str) else identity)
+
+    def claim(self, key: bytes) -> bool:
+        """
+        Take message for handling.
+
+        :return: False if message is already handled or is being handled right now.
+        """
+        if key in self._claimed or self._is_handled(key):
+            self._hits_counter.inc()
+            return False
+
+        self._misses_counter.inc()
+        self._claimed.add(key)
+        return True
+
+    def commit(self, key: bytes) -> None:
+        """
+        Remember claimed message as handled.
+        """
+        self._claimed.discard(key)
+        expires_at = time.time() + self._ttl_secs
+        self._remember(key, expires_at)
+        if self._index is not None:
+            self._index.add(key, expires_at)
+
+    def release(self, key: bytes) -> None:
+        """
+        Forget claimed message, which failed to be handled, so it can be handled again.
+        """
+        self._claimed.discard(key)
+
+    def close(self) -> None:
+        if self._index is not None:
+            self._index.close()
+
+    def _is_handled(self, key: bytes) -> bool:
+        now = time.time()
+        expires_at = self._handled.get(key)
+        if expires_at is not None:
+            if expires_at > now:
+                return True
+            del self._handled[key]
+
+        if self._index is not None:
+            expires_at = self._index.get(key)
+            if expires_at is not None and expires_at > now:
+                # Seen before restart or evicted from memory
+                self._remember(key, expires_at)
+                return True
+
+        return False
+
+    def _remember(self, key: bytes, expires_at: float) -> None:
+        self._handled[key] = expires_at
+        self._handled.move_to_end(key)
+        while len(self._handled) > self._max_size:
+            self._handled.popitem(last=False)
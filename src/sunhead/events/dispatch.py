@@ -0,0 +1,301 @@
+"""
+Concurrent message dispatching to the subscribers.
+
+Every incoming message is handled in its own task, so slow subscriber does not stall the whole consumer.
+Each subscriber has a limit of messages it handles at the same time. It is taken from the subscriber's
+``MAX_IN_FLIGHT`` attribute, or from the dispatcher default. Messages over the limit wait for a free slot.
+
+Subscribers with ``BATCH_SIZE`` receive messages in batches through ``on_batch``. Every batch takes
+one in-flight slot. Each message of the batch is acknowledged or rejected according to the batch result.
+"""
+
+import asyncio
+from functools import partial
+import logging
+from typing import AnyStr, Callable, List, Optional, Sequence, Tuple
+
+from sunhead.events import exceptions
+from sunhead.events.abc import AbstractSubscriber
+from sunhead.events.message import LazyBody, Message
+from sunhead.events.metrics import (
+    get_stream_metrics, DISPATCH_IN_FLIGHT, DISPATCH_WAITING, DISPATCH_QUEUE_WAIT,
+)
+from sunhead.events.types import Transferrable
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("Dispatcher", )
+
+
+class Dispatcher(object):
+
+    ACK_AFTER_PROCESSING = "after"
+    ACK_ON_RECEIVE = "early"
+    ACK_MODES = (ACK_AFTER_PROCESSING, ACK_ON_RECEIVE)
+
+    DEFAULT_MAX_IN_FLIGHT = 1
+
+    def __init__(self, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, ack_mode: str = ACK_AFTER_PROCESSING):
+        """
+        :param max_in_flight: Default limit of simultaneously handled messages per subscriber.
+        :param ack_mode: ``after`` to acknowledge message when all subscribers are done with it,
+            ``early`` to acknowledge it right after it is received.
+        """
+        if ack_mode not in self.ACK_MODES:
+            raise exceptions.ConsumerError("Unknown ack mode '%s'" % ack_mode)
+
+        self._max_in_flight = max_in_flight
+        self._ack_mode = ack_mode
+        self._semaphores = {}
+        self._batchers = {}
+        self._tasks = set()
+        self._stats = DispatchStats()
+
+        metrics = get_stream_metrics()
+        self._in_flight_gauge = metrics.gauges[metrics.prefix(DISPATCH_IN_FLIGHT)]
+        self._waiting_gauge = metrics.gauges[metrics.prefix(DISPATCH_WAITING)]
+        self._queue_wait_summary = metrics.summaries[metrics.prefix(DISPATCH_QUEUE_WAIT)]
+
+    @property
+    def max_in_flight(self) -> int:
+        return self._max_in_flight
+
+    @property
+    def ack_mode(self) -> str:
+        return self._ack_mode
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    def collect_stats(self) -> "DispatchStats":
+        """
+        Get stats, gathered since the previous call, and start gathering new ones.
+        """
+        stats, self._stats = self._stats, DispatchStats()
+        self._stats.peak_pending = self.pending
+        return stats
+
+    def dispatch(
+            self,
+            subscribers: Sequence[AbstractSubscriber],
+            data: Transferrable,
+            topic: AnyStr,
+            settle: Callable,
+            reply: Optional[Callable] = None) -> None:
+        """
+        Schedule message handling and return immediately.
+
+        :param subscribers: Who will receive the message.
+        :param data: Message body. ``Message`` and ``LazyBody`` are deserialized only for subscribers
+            without ``RAW_DELIVERY``. ``Message`` is released to its pool when handled.
+        :param topic: Routing key of the message.
+        :param settle: Coroutine function, called with ``True`` when message must be acknowledged
+            and with ``False`` when it must be rejected.
+        :param reply: Coroutine function ``reply(result, error)`` for RPC requests. Called with the first
+            non-None value, returned by subscribers, or with the first exception, raised by them.
+        """
+        task = asyncio.ensure_future(self._process(subscribers, data, topic, settle, reply))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        self._stats.peak_pending = max(self._stats.peak_pending, self.pending)
+
+    async def join(self, timeout: float = None) -> None:
+        """
+        Wait until all scheduled messages are handled. Collected batches are handled right away.
+        """
+        for batcher in self._batchers.values():
+            batcher.flush()
+        if not self._tasks:
+            return
+        await asyncio.wait(set(self._tasks), timeout=timeout)
+
+    async def _process(self, subscribers, data, topic, settle, reply=None) -> None:
+        if self._ack_mode == self.ACK_ON_RECEIVE:
+            await self._settle(settle, True)
+
+        loop = asyncio.get_event_loop()
+        started_at = loop.time()
+        results = await asyncio.gather(
+            *(self._run_subscriber(subscriber, data, topic) for subscriber in subscribers),
+            return_exceptions=True
+        )
+        succeeded = not any(isinstance(result, Exception) for result in results)
+        self._stats.handled += 1
+        self._stats.handling_secs += loop.time() - started_at
+
+        if reply is not None:
+            await self._reply(reply, results)
+
+        if self._ack_mode == self.ACK_AFTER_PROCESSING:
+            await self._settle(settle, succeeded)
+
+        if isinstance(data, Message):
+            data.release()
+
+    async def _reply(self, reply: Callable, results: List) -> None:
+        error = next((result for result in results if isinstance(result, Exception)), None)
+        value = next((result for result in results if result is not None and error is None), None)
+        try:
+            await reply(value, error)
+        except Exception:
+            logger.error("Can't send reply", exc_info=True)
+
+    async def _settle(self, settle: Callable, succeeded: bool) -> None:
+        try:
+            await settle(succeeded)
+        except Exception:
+            logger.error("Can't settle message (succeeded=%s)", succeeded, exc_info=True)
+
+    async def _run_subscriber(self, subscriber: AbstractSubscriber, data: Transferrable, topic: AnyStr):
+        if getattr(subscriber, "BATCH_SIZE", None):
+            await self._get_batcher(subscriber).submit(data, topic)
+            return
+
+        await self._acquire_slot(subscriber)
+        try:
+            return await subscriber.on_message(self._get_payload(subscriber, data), topic)
+        except Exception:
+            logger.error("Subscriber '%s' failed to handle message with key '%s'", subscriber, topic, exc_info=True)
+            raise
+        finally:
+            self._release_slot(subscriber)
+
+    async def _run_batch(self, subscriber: AbstractSubscriber, batch: List[Tuple]) -> None:
+        messages, futures = [], []
+        for data, topic, future in batch:
+            try:
+                messages.append((self._get_payload(subscriber, data), topic))
+            except exceptions.SerializationError as e:
+                future.set_exception(e)
+            else:
+                futures.append(future)
+
+        if not messages:
+            return
+
+        await self._acquire_slot(subscriber)
+        try:
+            await subscriber.on_batch(messages)
+        except exceptions.PartialBatchError as e:
+            failed = set(e.failed)
+            logger.error("Subscriber '%s' failed to handle %s of %s messages", subscriber, len(failed), len(messages))
+            for idx, future in enumerate(futures):
+                if idx in failed:
+                    future.set_exception(e)
+                else:
+                    future.set_result(None)
+        except Exception as e:
+            logger.error("Subscriber '%s' failed to handle batch", subscriber, exc_info=True)
+            for future in futures:
+                future.set_exception(e)
+        else:
+            for future in futures:
+                future.set_result(None)
+        finally:
+            self._release_slot(subscriber)
+
+    def _get_payload(self, subscriber: AbstractSubscriber, data: Transferrable):
+        if isinstance(data, (Message, LazyBody)) and not getattr(subscriber, "RAW_DELIVERY", False):
+            return data.data
+        return data
+
+    async def _acquire_slot(self, subscriber: AbstractSubscriber) -> None:
+        semaphore = self._get_semaphore(subscriber)
+        loop = asyncio.get_event_loop()
+        waiting = self._waiting_gauge.labels(subscriber.name)
+
+        waiting.inc()
+        enqueued_at = loop.time()
+        try:
+            await semaphore.acquire()
+        finally:
+            waiting.dec()
+        self._queue_wait_summary.labels(subscriber.name).observe(loop.time() - enqueued_at)
+        self._in_flight_gauge.labels(subscriber.name).inc()
+
+    def _release_slot(self, subscriber: AbstractSubscriber) -> None:
+        self._in_flight_gauge.labels(subscriber.name).dec()
+        self._get_semaphore(subscriber).release()
+
+    def _get_semaphore(self, subscriber: AbstractSubscriber) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(subscriber)
+        if semaphore is None:
+            limit = getattr(subscriber, "MAX_IN_FLIGHT", None) or self._max_in_flight
+            semaphore = asyncio.Semaphore(limit)
+            self._semaphores[subscriber] = semaphore
+        return semaphore
+
+    def _get_batcher(self, subscriber: AbstractSubscriber) -> "Batcher":
+        batcher = self._batchers.get(subscriber)
+        if batcher is None:
+            batcher = Batcher(
+                partial(self._run_batch, subscriber),
+                batch_size=subscriber.BATCH_SIZE,
+                linger_secs=getattr(subscriber, "BATCH_LINGER_SECS", Batcher.DEFAULT_LINGER_SECS),
+            )
+            self._batchers[subscriber] = batcher
+        return batcher
+
+
+class DispatchStats(object):
+
+    __slots__ = ("handled", "handling_secs", "peak_pending")
+
+    def __init__(self):
+        self.handled = 0
+        self.handling_secs = 0.0
+        self.peak_pending = 0
+
+    @property
+    def average_latency(self) -> float:
+        return self.handling_secs / self.handled if self.handled else 0.0
+
+
+class Batcher(object):
+    """
+    Collects messages for the subscriber's ``on_batch``. Batch is handled when it is full or linger time is over.
+    """
+
+    DEFAULT_LINGER_SECS = 0.05
+
+    def __init__(self, run: Callable, batch_size: int, linger_secs: float = DEFAULT_LINGER_SECS):
+        """
+        :param run: Coroutine function ``run(batch)``, which handles batch of ``(data, topic, future)``
+            and resolves every future.
+        """
+        self._run = run
+        self._batch_size = batch_size
+        self._linger_secs = linger_secs
+        self._batch = []
+        self._linger_handle = None
+        self._tasks = set()
+
+    def submit(self, data: Transferrable, topic: AnyStr) -> asyncio.Future:
+        """
+        :return: Future, resolved when batch with this message is handled.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._batch.append((data, topic, future))
+
+        if len(self._batch) >= self._batch_size:
+            self.flush()
+        elif self._linger_handle is None:
+            self._linger_handle = asyncio.get_event_loop().call_later(self._linger_secs, self.flush)
+
+        return future
+
+    def flush(self) -> None:
+        if self._linger_handle is not None:
+            self._linger_handle.cancel()
+            self._linger_handle = None
+
+        if not self._batch:
+            return
+
+        batch, self._batch = self._batch, []
+        task = asyncio.ensure_future(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
@@ -15,5 +15,17 @@ class PublisherError(StreamConnectionError):
     """Problem with message publisher"""
 
 
+class PartialBatchError(ConsumerError):
+    """Some messages of the batch are failed. Their indices are in ``failed``"""
+
+    def __init__(self, failed, *args):
+        super().__init__(*args)
+        self.failed = tuple(failed)
+
+
+class RPCError(Exception):
+    """Remote subscriber failed to handle the call"""
+
+
 class SerializationError(Exception):
     """Error serializing or deserializing data"""
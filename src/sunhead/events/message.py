@@ -0,0 +1,147 @@
+"""
+Message containers, passed from transports to subscribers.
+"""
+
+import sys
+from typing import AnyStr, Optional
+
+from sunhead.events.abc import AbstractSerializer
+from sunhead.events.types import Serialized, Transferrable
+
+
+__all__ = ("LazyBody", "Message")
+
+
+_NOT_DECODED = object()
+
+
+class LazyBody(object):
+    """
+    Serialized message body, which is deserialized on first access to ``data`` and only once.
+
+    Subscribers with ``RAW_DELIVERY`` receive it as is, so they can forward or store ``raw`` bytes
+    without paying for deserialization.
+    """
+
+    __slots__ = ("_raw", "_serializer", "_data")
+
+    def __init__(self, raw: Serialized, serializer: AbstractSerializer):
+        self._raw = raw
+        self._serializer = serializer
+        self._data = _NOT_DECODED
+
+    def __len__(self):
+        return len(self._raw)
+
+    @property
+    def raw(self) -> memoryview:
+        raw = self._raw.encode("utf-8") if isinstance(self._raw, str) else self._raw
+        return memoryview(raw)
+
+    @property
+    def is_decoded(self) -> bool:
+        return self._data is not _NOT_DECODED
+
+    def set_data(self, data: Transferrable) -> None:
+        """
+        Set data, which was deserialized elsewhere, e.g. off the event loop.
+        """
+        self._data = data
+
+    @property
+    def data(self) -> Transferrable:
+        if self._data is _NOT_DECODED:
+            self._data = self._serializer.deserialize(self._raw)
+        return self._data
+
+
+class Message(object):
+    """
+    Received message with its metadata. Subscribers with ``RAW_DELIVERY`` receive it instead of deserialized data.
+
+    ``raw``, ``data`` and ``is_decoded`` are taken from the body, so it can be used wherever ``LazyBody`` was.
+
+    Instances are pooled. Transport takes one with ``acquire`` and dispatcher gives it back with ``release``
+    when message is handled. Message is reused only if nobody else holds a reference to it by then,
+    so subscribers are free to keep it.
+    """
+
+    __slots__ = ("body", "routing_key", "properties", "delivery_tag", "redelivered", "received_at", "__weakref__")
+
+    MAX_POOL_SIZE = 1024
+
+    _pool = []
+
+    def __init__(self):
+        self._clear()
+
+    @classmethod
+    def acquire(
+            cls,
+            body: LazyBody,
+            routing_key: AnyStr,
+            properties=None,
+            delivery_tag: Optional[int] = None,
+            redelivered: bool = False,
+            received_at: Optional[float] = None) -> "Message":
+        """
+        :param body: Message body.
+        :param routing_key: Routing key (topic) of the message.
+        :param properties: Transport-specific message properties, e.g. AMQP content type and headers.
+        :param delivery_tag: Transport-specific identifier of the delivery, e.g. AMQP delivery tag or log offset.
+        :param redelivered: Whether message was delivered before and was not acknowledged.
+        :param received_at: Unix timestamp of the message receipt.
+        """
+        message = cls._pool.pop() if cls._pool else cls()
+        message.body = body
+        message.routing_key = routing_key
+        message.properties = properties
+        message.delivery_tag = delivery_tag
+        message.redelivered = redelivered
+        message.received_at = received_at
+        return message
+
+    def release(self) -> None:
+        """
+        Return message to the pool, unless somebody still holds it.
+        """
+        if sys.getrefcount(self) > _FREE_REFCOUNT or len(self._pool) >= self.MAX_POOL_SIZE:
+            return
+        self._clear()
+        self._pool.append(self)
+
+    def _get_refcount(self) -> int:
+        # Must see the same references as ``release`` does
+        return sys.getrefcount(self)
+
+    def _clear(self) -> None:
+        self.body = None
+        self.routing_key = None
+        self.properties = None
+        self.delivery_tag = None
+        self.redelivered = False
+        self.received_at = None
+
+    def __len__(self):
+        return len(self.body)
+
+    @property
+    def raw(self) -> memoryview:
+        return self.body.raw
+
+    @property
+    def is_decoded(self) -> bool:
+        return self.body.is_decoded
+
+    @property
+    def data(self) -> Transferrable:
+        return self.body.data
+
+
+def _get_free_refcount() -> int:
+    # Refcount, seen by ``release``, when message is held only by a local variable of the caller
+    message = Message()
+    return message._get_refcount()
+
+
+_FREE_REFCOUNT = _get_free_refcount()
@@ -0,0 +1,98 @@
+"""
+Metrics of the messaging stuff. Everything is registered once in the ``stream`` metrics container.
+
+Usage::
+
+    metrics = get_stream_metrics()
+    metrics.gauges[metrics.prefix(DISPATCH_IN_FLIGHT)].labels("my_subscriber").inc()
+"""
+
+from sunhead.metrics import get_metrics, Metrics
+
+
+__all__ = ("get_stream_metrics", )
+
+
+STREAM_METRICS_NAME = "stream"
+
+DISPATCH_IN_FLIGHT = "stream_dispatch_in_flight"
+DISPATCH_WAITING = "stream_dispatch_waiting"
+DISPATCH_QUEUE_WAIT = "stream_dispatch_queue_wait_seconds"
+
+PUBLISH_BATCH_SIZE = "stream_publish_batch_size"
+PUBLISH_OUTSTANDING_CONFIRMS = "stream_publish_outstanding_confirms"
+
+OUTBOX_DEPTH = "stream_outbox_depth"
+OUTBOX_BYTES = "stream_outbox_bytes"
+OUTBOX_DROPPED = "stream_outbox_dropped_total"
+
+RECONNECT_ATTEMPTS = "stream_reconnect_attempts_total"
+RECONNECT_RECOVERY = "stream_reconnect_recovery_seconds"
+
+QOS_PREFETCH = "stream_qos_prefetch"
+
+COMPRESSION_RATIO = "stream_compression_ratio"
+
+DECODE_PENDING = "stream_decode_pending"
+DECODE_LATENCY = "stream_decode_latency_seconds"
+
+RPC_LATENCY = "stream_rpc_latency_seconds"
+
+DEDUP_HITS = "stream_dedup_hits_total"
+DEDUP_MISSES = "stream_dedup_misses_total"
+
+PUBLISH_TO_RECEIVE = "stream_publish_to_receive_seconds"
+RECEIVE_TO_ACK = "stream_receive_to_ack_seconds"
+
+# Backlog may keep messages for minutes, default buckets end at 10 seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, float("inf"))
+
+_initialized = False
+
+
+def init_stream_metrics(metrics: Metrics) -> None:
+    metrics.add_gauge(
+        metrics.prefix(DISPATCH_IN_FLIGHT), "Messages being handled by subscriber right now", ("subscriber", ))
+    metrics.add_gauge(
+        metrics.prefix(DISPATCH_WAITING), "Messages waiting for subscriber in-flight slot", ("subscriber", ))
+    metrics.add_summary(
+        metrics.prefix(DISPATCH_QUEUE_WAIT), "Time spent waiting for subscriber in-flight slot", ("subscriber", ))
+
+    metrics.add_summary(metrics.prefix(PUBLISH_BATCH_SIZE), "Messages in flushed publish batch")
+    metrics.add_gauge(metrics.prefix(PUBLISH_OUTSTANDING_CONFIRMS), "Published messages waiting for broker confirm")
+
+    metrics.add_gauge(metrics.prefix(OUTBOX_DEPTH), "Messages waiting in outbox for the connection")
+    metrics.add_gauge(metrics.prefix(OUTBOX_BYTES), "Bytes of messages waiting in outbox")
+    metrics.add_counter(metrics.prefix(OUTBOX_DROPPED), "Messages dropped because outbox is full")
+
+    metrics.add_counter(metrics.prefix(RECONNECT_ATTEMPTS), "Attempts to restore lost Stream connection")
+    metrics.add_summary(metrics.prefix(RECONNECT_RECOVERY), "Time from connection loss to restored consuming")
+
+    metrics.add_gauge(metrics.prefix(QOS_PREFETCH), "Prefetch count, chosen by adaptive QoS controller")
+
+    metrics.add_summary(
+        metrics.prefix(COMPRESSION_RATIO), "Original to compressed size ratio of message bodies", ("codec", ))
+
+    metrics.add_gauge(metrics.prefix(DECODE_PENDING), "Large message bodies queued or being decoded in the pool")
+    metrics.add_summary(metrics.prefix(DECODE_LATENCY), "Time to decode large message body in the pool")
+
+    metrics.add_histogram(metrics.prefix(RPC_LATENCY), "Time from RPC request to its reply", ("topic", ))
+
+    metrics.add_counter(metrics.prefix(DEDUP_HITS), "Received messages skipped as already handled")
+    metrics.add_counter(metrics.prefix(DEDUP_MISSES), "Received messages not seen before")
+
+    metrics.add_histogram(
+        metrics.prefix(PUBLISH_TO_RECEIVE), "Time from message publish to its receipt by consumer",
+        ("routing_key", ), buckets=LATENCY_BUCKETS)
+    metrics.add_histogram(
+        metrics.prefix(RECEIVE_TO_ACK), "Time from message receipt to its acknowledgement",
+        ("routing_key", ), buckets=LATENCY_BUCKETS)
+
+
+def get_stream_metrics() -> Metrics:
+    global _initialized
+    metrics = get_metrics(STREAM_METRICS_NAME)
+    if not _initialized:
+        init_stream_metrics(metrics)
+        _initialized = True
+    return metrics
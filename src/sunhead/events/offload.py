@@ -0,0 +1,138 @@
+"""
+Running CPU-heavy subscriber handlers in a thread or process pool, so they don't block the event loop.
+
+Number of jobs, submitted to the pool, is limited. When limit is reached, handler waits for a free place,
+holding its in-flight slot, so the prefetch window fills up and broker stops sending more messages.
+
+Usage::
+
+    class Resizer(OffloadSubscriber):
+
+        EXECUTOR = EXECUTOR_PROCESS
+
+        def handle(self, data, topic):
+            return resize(data["image"])
+
+or, for a single handler::
+
+    class Resizer(AbstractSubscriber):
+
+        @offload(max_pending=8)
+        def on_message(self, data, topic):
+            return resize(data["image"])
+"""
+
+from abc import abstractmethod
+import asyncio
+from functools import partial, wraps
+import logging
+from typing import AnyStr, Callable, Optional
+
+from sunhead.events.abc import AbstractSubscriber
+from sunhead.events.types import Transferrable
+from sunhead.utils import make_executor, EXECUTOR_THREAD, EXECUTOR_PROCESS  # noqa
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("OffloadPool", "OffloadSubscriber", "offload")
+
+
+class OffloadPool(object):
+
+    DEFAULT_MAX_PENDING = 4
+
+    def __init__(self, kind: str = EXECUTOR_THREAD, max_workers: Optional[int] = None,
+                 max_pending: int = DEFAULT_MAX_PENDING):
+        """
+        :param kind: ``thread`` or ``process``. Process pool needs picklable handler and arguments.
+        :param max_workers: Size of the pool.
+        :param max_pending: How many jobs may be submitted to the pool at once.
+        """
+        self._kind = kind
+        self._max_workers = max_workers
+        self._max_pending = max_pending
+        # Made on first use, so that pool and semaphore belong to the process and loop, which use them
+        self._executor = None
+        self._semaphore = None
+
+    async def run(self, func: Callable, *args):
+        """
+        Run function in the pool, when there is a place for it.
+
+        :return: Result of the function. Its exception is raised here.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_pending)
+        if self._executor is None:
+            self._executor = make_executor(self._kind, max_workers=self._max_workers)
+
+        await self._semaphore.acquire()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self._executor, partial(func, *args))
+        finally:
+            self._semaphore.release()
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+
+class OffloadSubscriber(AbstractSubscriber):
+    """
+    Subscriber, whose ``handle`` runs in the pool. With process pool, subscriber itself is pickled
+    with every message, so keep it light.
+    """
+
+    EXECUTOR = EXECUTOR_THREAD
+    EXECUTOR_WORKERS = None
+    MAX_PENDING_JOBS = OffloadPool.DEFAULT_MAX_PENDING
+
+    _offload_pool = None
+
+    @property
+    def MAX_IN_FLIGHT(self) -> int:
+        # Let dispatcher hand over enough messages to keep the pool busy, whatever ``MAX_PENDING_JOBS`` is
+        return self.MAX_PENDING_JOBS
+
+    @abstractmethod
+    def handle(self, data: Transferrable, topic: AnyStr):
+        """
+        Handle message. Runs in the pool, so it must not touch the event loop.
+        """
+        pass
+
+    async def on_message(self, data: Transferrable, topic: AnyStr):
+        if self._offload_pool is None:
+            self._offload_pool = OffloadPool(
+                self.EXECUTOR, max_workers=self.EXECUTOR_WORKERS, max_pending=self.MAX_PENDING_JOBS)
+        return await self._offload_pool.run(self.handle, data, topic)
+
+    def __getstate__(self):
+        # Pool is of no use in the worker process and can't be pickled anyway
+        state = self.__dict__.copy()
+        state.pop("_offload_pool", None)
+        return state
+
+
+def offload(kind: str = EXECUTOR_THREAD, max_workers: Optional[int] = None,
+            max_pending: int = OffloadPool.DEFAULT_MAX_PENDING) -> Callable:
+    """
+    Make coroutine function out of the blocking handler, which runs it in the pool.
+    Every decorated handler has its own pool.
+
+    Process pool can't pickle decorated methods, use ``OffloadSubscriber`` for it instead.
+    """
+    pool = OffloadPool(kind, max_workers=max_workers, max_pending=max_pending)
+
+    def decorator(func: Callable) -> Callable:
+
+        @wraps(func)
+        async def wrapper(*args):
+            return await pool.run(func, *args)
+
+        return wrapper
+
+    return decorator
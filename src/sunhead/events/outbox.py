@@ -0,0 +1,212 @@
+"""
+Outbox for the messages, published while transport is disconnected.
+
+Messages are kept in memory first. When memory part is full, they are spilled to the memory-mapped
+append-only segment file. Once the transport is connected again, outbox is drained in publish order.
+
+Segment file keeps its read and write offsets in the header, so spilled messages survive process restart,
+if the same path is used.
+
+Every message keeps the time it was put into outbox, so it can be sent with its original publish time.
+"""
+
+from collections import deque
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import AnyStr, Optional, Tuple
+
+from sunhead.events.metrics import (
+    get_stream_metrics, OUTBOX_DEPTH, OUTBOX_BYTES, OUTBOX_DROPPED,
+)
+from sunhead.events.types import Serialized
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("Outbox", )
+
+
+class SpillSegment(object):
+
+    HEADER = struct.Struct(">QQ")
+    RECORD_HEADER = struct.Struct(">IHd")
+
+    def __init__(self, path: str, size: int):
+        exists = os.path.isfile(path) and os.path.getsize(path) > self.HEADER.size
+        self._path = path
+        self._file = open(path, "r+b" if exists else "w+b")
+        self._size = max(size, os.path.getsize(path))
+        if os.path.getsize(path) < self._size:
+            self._file.truncate(self._size)
+        self._mmap = mmap.mmap(self._file.fileno(), self._size)
+
+        self._read_offset, self._write_offset = self.HEADER.size, self.HEADER.size
+        self._count = 0
+        if exists:
+            self._read_offset, self._write_offset = self.HEADER.unpack_from(self._mmap, 0)
+            self._count = self._count_records()
+            if self._count:
+                logger.info("Found %s spilled messages in '%s'", self._count, path)
+        self._write_header()
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def bytes_used(self) -> int:
+        return self._write_offset - self._read_offset
+
+    def append(self, body: bytes, topic: AnyStr, published_at: float) -> bool:
+        topic = topic.encode("utf-8")
+        record_size = self.RECORD_HEADER.size + len(topic) + len(body)
+        if self._write_offset + record_size > self._size:
+            return False
+
+        offset = self._write_offset
+        self.RECORD_HEADER.pack_into(self._mmap, offset, len(body), len(topic), published_at)
+        offset += self.RECORD_HEADER.size
+        self._mmap[offset:offset + len(topic)] = topic
+        offset += len(topic)
+        self._mmap[offset:offset + len(body)] = body
+        self._write_offset = offset + len(body)
+        self._count += 1
+        self._write_header()
+        return True
+
+    def peek(self) -> Optional[Tuple[bytes, str, float]]:
+        if not self._count:
+            return None
+        body, topic, published_at, _ = self._read_record(self._read_offset)
+        return body, topic, published_at
+
+    def pop(self) -> None:
+        if not self._count:
+            return
+        _, _, _, self._read_offset = self._read_record(self._read_offset)
+        self._count -= 1
+        if not self._count:
+            # Everything is drained, start writing from the beginning again
+            self._read_offset = self._write_offset = self.HEADER.size
+        self._write_header()
+
+    def close(self) -> None:
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.close()
+
+    def _read_record(self, offset: int) -> Tuple[bytes, str, float, int]:
+        body_size, topic_size, published_at = self.RECORD_HEADER.unpack_from(self._mmap, offset)
+        offset += self.RECORD_HEADER.size
+        topic = self._mmap[offset:offset + topic_size].decode("utf-8")
+        offset += topic_size
+        body = self._mmap[offset:offset + body_size]
+        return body, topic, published_at, offset + body_size
+
+    def _count_records(self) -> int:
+        count = 0
+        offset = self._read_offset
+        while offset < self._write_offset:
+            body_size, topic_size, _ = self.RECORD_HEADER.unpack_from(self._mmap, offset)
+            offset += self.RECORD_HEADER.size + topic_size + body_size
+            count += 1
+        return count
+
+    def _write_header(self) -> None:
+        self.HEADER.pack_into(self._mmap, 0, self._read_offset, self._write_offset)
+
+
+class Outbox(object):
+
+    DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, capacity: int, spill_path: Optional[str] = None, segment_size: int = DEFAULT_SEGMENT_SIZE):
+        """
+        :param capacity: How many messages to keep in memory.
+        :param spill_path: Path to the segment file for the messages, which don't fit in memory.
+            No spilling when omitted, such messages are dropped.
+        :param segment_size: Size of the segment file in bytes.
+        """
+        self._capacity = capacity
+        self._memory = deque()
+        self._memory_bytes = 0
+        self._segment = SpillSegment(spill_path, segment_size) if spill_path else None
+
+        metrics = get_stream_metrics()
+        self._depth_gauge = metrics.gauges[metrics.prefix(OUTBOX_DEPTH)]
+        self._bytes_gauge = metrics.gauges[metrics.prefix(OUTBOX_BYTES)]
+        self._dropped_counter = metrics.counters[metrics.prefix(OUTBOX_DROPPED)]
+        self._update_metrics()
+
+    def __len__(self):
+        return len(self._memory) + self._spilled_count
+
+    @property
+    def bytes_used(self) -> int:
+        spilled = self._segment.bytes_used if self._segment is not None else 0
+        return self._memory_bytes + spilled
+
+    @property
+    def _spilled_count(self) -> int:
+        return len(self._segment) if self._segment is not None else 0
+
+    def put(self, body: Serialized, topic: AnyStr, published_at: Optional[float] = None) -> bool:
+        """
+        Add message to the end of outbox.
+
+        :param published_at: Publish time of the message. Current time if omitted.
+        :return: Whether message is stored. Message is dropped when outbox is full.
+        """
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        if published_at is None:
+            published_at = time.time()
+
+        # Once anything is spilled, everything goes to the disk until it's drained, to keep the order
+        if len(self._memory) < self._capacity and not self._spilled_count:
+            self._memory.append((body, topic, published_at))
+            self._memory_bytes += len(body)
+            stored = True
+        else:
+            stored = self._segment is not None and self._segment.append(body, topic, published_at)
+
+        if not stored:
+            logger.warning("Outbox is full, message with key '%s' dropped", topic)
+            self._dropped_counter.inc()
+
+        self._update_metrics()
+        return stored
+
+    def peek(self) -> Optional[Tuple[bytes, str, float]]:
+        """
+        Oldest message in outbox, as ``(body, topic, published_at)``.
+        Call ``pop`` after it is published to remove it.
+        """
+        if self._memory:
+            return self._memory[0]
+        if self._segment is not None:
+            return self._segment.peek()
+        return None
+
+    def pop(self) -> None:
+        if self._memory:
+            body, _, _ = self._memory.popleft()
+            self._memory_bytes -= len(body)
+        elif self._segment is not None:
+            self._segment.pop()
+        self._update_metrics()
+
+    def close(self) -> None:
+        if self._segment is not None:
+            self._segment.close()
+
+    def _update_metrics(self) -> None:
+        self._depth_gauge.set(len(self))
+        self._bytes_gauge.set(self.bytes_used)
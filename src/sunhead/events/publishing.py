@@ -0,0 +1,139 @@
+"""
+Batched publishing with broker confirmations.
+
+Published messages are collected into batches, which are flushed when batch is full or when linger
+time is over. Batch is sent in one go, without waiting for the broker confirmation of each message,
+but the number of messages waiting for confirmation is limited.
+
+Confirmation is waited for limited time, so a message, which broker never confirms, doesn't hold
+its place in the confirms window forever. It is reported as failed, though it may have reached the broker.
+
+Each published message gets a future, resolved when broker confirms it.
+"""
+
+import asyncio
+from functools import partial
+import logging
+from typing import AnyStr, Callable, Optional
+
+from sunhead.events.metrics import (
+    get_stream_metrics, PUBLISH_BATCH_SIZE, PUBLISH_OUTSTANDING_CONFIRMS,
+)
+from sunhead.events.types import Serialized
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("PublishPipeline", )
+
+
+class PublishPipeline(object):
+
+    DEFAULT_BATCH_SIZE = 100
+    DEFAULT_LINGER_SECS = 0.005
+    DEFAULT_MAX_OUTSTANDING_CONFIRMS = 1000
+    DEFAULT_CONFIRM_TIMEOUT_SECS = 30
+
+    def __init__(
+            self,
+            publish: Callable,
+            batch_size: int = DEFAULT_BATCH_SIZE,
+            linger_secs: float = DEFAULT_LINGER_SECS,
+            max_outstanding_confirms: int = DEFAULT_MAX_OUTSTANDING_CONFIRMS,
+            confirm_timeout_secs: float = DEFAULT_CONFIRM_TIMEOUT_SECS):
+        """
+        :param publish: Coroutine function ``publish(body, topic, properties)``, which returns when broker
+            confirmed message.
+        :param batch_size: Flush batch when it has that many messages.
+        :param linger_secs: Flush batch when first message in it waits that long.
+        :param max_outstanding_confirms: How many messages may wait for the broker confirmation.
+        :param confirm_timeout_secs: Fail message with ``asyncio.TimeoutError``, if it is not confirmed that long.
+            Just a safety net for lost confirmations, broker normally confirms messages in milliseconds.
+        """
+        self._publish = publish
+        self._batch_size = batch_size
+        self._linger_secs = linger_secs
+        self._confirm_timeout_secs = confirm_timeout_secs
+        self._confirms_semaphore = asyncio.Semaphore(max_outstanding_confirms)
+        self._send_lock = asyncio.Lock()
+        self._batch = []
+        self._linger_handle = None
+        self._unconfirmed = set()
+
+        metrics = get_stream_metrics()
+        self._batch_size_summary = metrics.summaries[metrics.prefix(PUBLISH_BATCH_SIZE)]
+        self._outstanding_gauge = metrics.gauges[metrics.prefix(PUBLISH_OUTSTANDING_CONFIRMS)]
+
+    @property
+    def pending(self) -> int:
+        return len(self._batch) + len(self._unconfirmed)
+
+    def submit(self, body: Serialized, topic: AnyStr, properties: Optional[dict] = None) -> asyncio.Future:
+        """
+        Put message into the current batch.
+
+        :param properties: Message properties, passed to ``publish`` as is.
+
+        :return: Future, which is resolved when broker confirms the message.
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._batch.append((body, topic, properties, future))
+        self._unconfirmed.add(future)
+        future.add_done_callback(self._unconfirmed.discard)
+
+        if len(self._batch) >= self._batch_size:
+            self._flush_batch()
+        elif self._linger_handle is None:
+            self._linger_handle = asyncio.get_event_loop().call_later(self._linger_secs, self._flush_batch)
+
+        return future
+
+    async def flush(self, timeout: float = None) -> None:
+        """
+        Send current batch right away and wait for all messages to be confirmed.
+        """
+        self._flush_batch()
+        if not self._unconfirmed:
+            return
+        await asyncio.wait(set(self._unconfirmed), timeout=timeout)
+
+    def _flush_batch(self) -> None:
+        if self._linger_handle is not None:
+            self._linger_handle.cancel()
+            self._linger_handle = None
+
+        if not self._batch:
+            return
+
+        batch, self._batch = self._batch, []
+        self._batch_size_summary.observe(len(batch))
+        asyncio.ensure_future(self._send_batch(batch))
+
+    async def _send_batch(self, batch) -> None:
+        # Lock keeps batches in publish order, even if some of them wait for the confirms window
+        async with self._send_lock:
+            for body, topic, properties, future in batch:
+                await self._confirms_semaphore.acquire()
+                self._outstanding_gauge.inc()
+                confirmation = asyncio.ensure_future(
+                    asyncio.wait_for(self._publish(body, topic, properties), self._confirm_timeout_secs))
+                confirmation.add_done_callback(partial(self._on_confirmation, future))
+
+    def _on_confirmation(self, future: asyncio.Future, confirmation: asyncio.Future) -> None:
+        self._confirms_semaphore.release()
+        self._outstanding_gauge.dec()
+
+        if future.done():
+            return
+
+        if confirmation.cancelled():
+            future.cancel()
+            return
+
+        error = confirmation.exception()
+        if error is not None:
+            logger.warning("Message is not confirmed by broker: %r", error)
+            future.set_exception(error)
+        else:
+            future.set_result(None)
@@ -0,0 +1,108 @@
+"""
+Adaptive prefetch (QoS) control for consumers.
+
+Periodically looks at the dispatcher stats. When handling takes longer than the target latency, prefetch
+is lowered, so less messages wait in the consumer and get redelivered in case of failure. When the whole
+prefetch window is busy with handlers, prefetch is raised, so fast handlers are not starved.
+"""
+
+import logging
+from typing import Callable, Optional
+
+from sunhead.events.dispatch import Dispatcher, DispatchStats
+from sunhead.events.metrics import get_stream_metrics, QOS_PREFETCH
+from sunhead.periodical import crontab
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("PrefetchController", )
+
+
+class PrefetchController(object):
+
+    DEFAULT_INTERVAL_SECS = 5
+    DEFAULT_TARGET_UTILIZATION = 0.8
+    INCREASE_FACTOR = 1.5
+    DECREASE_FACTOR = 0.7
+
+    def __init__(
+            self,
+            dispatcher: Dispatcher,
+            apply: Callable,
+            min_prefetch: int,
+            max_prefetch: int,
+            initial_prefetch: Optional[int] = None,
+            target_latency_secs: Optional[float] = None,
+            target_utilization: float = DEFAULT_TARGET_UTILIZATION,
+            interval_secs: int = DEFAULT_INTERVAL_SECS):
+        """
+        :param dispatcher: Dispatcher of the consumer, whose stats are used.
+        :param apply: Coroutine function ``apply(prefetch)``, which sets new prefetch count.
+        :param min_prefetch: Prefetch won't go lower than that.
+        :param max_prefetch: Prefetch won't go higher than that.
+        :param initial_prefetch: Prefetch to start with. ``min_prefetch`` if omitted.
+        :param target_latency_secs: Lower prefetch, when average handling time is above that.
+        :param target_utilization: Raise prefetch, when that part of prefetch window is busy with handlers.
+        :param interval_secs: How often to adjust prefetch.
+        """
+        self._dispatcher = dispatcher
+        self._apply = apply
+        self._min_prefetch = min_prefetch
+        self._max_prefetch = max_prefetch
+        self._prefetch = self._clamp(initial_prefetch or min_prefetch)
+        self._target_latency_secs = target_latency_secs
+        self._target_utilization = target_utilization
+        self._adjuster = crontab("* * * * * */{}".format(interval_secs), func=self.adjust, start=False)
+        self._started = False
+
+        metrics = get_stream_metrics()
+        self._prefetch_gauge = metrics.gauges[metrics.prefix(QOS_PREFETCH)]
+        self._prefetch_gauge.set(self._prefetch)
+
+    @property
+    def prefetch(self) -> int:
+        return self._prefetch
+
+    def start(self) -> None:
+        if self._started:
+            return
+        self._dispatcher.collect_stats()
+        self._adjuster.start()
+        self._started = True
+
+    def stop(self) -> None:
+        if not self._started:
+            return
+        self._adjuster.stop()
+        self._started = False
+
+    async def adjust(self) -> None:
+        prefetch = self._get_next_prefetch(self._dispatcher.collect_stats())
+        if prefetch == self._prefetch:
+            return
+
+        logger.info("Changing prefetch count %s -> %s", self._prefetch, prefetch)
+        try:
+            await self._apply(prefetch)
+        except Exception:
+            logger.warning("Can't change prefetch count", exc_info=True)
+            return
+
+        self._prefetch = prefetch
+        self._prefetch_gauge.set(prefetch)
+
+    def _get_next_prefetch(self, stats: DispatchStats) -> int:
+        if self._target_latency_secs is not None and stats.handled \
+                and stats.average_latency > self._target_latency_secs:
+            return self._clamp(int(self._prefetch * self.DECREASE_FACTOR))
+
+        utilization = stats.peak_pending / self._prefetch
+        if utilization >= self._target_utilization:
+            return self._clamp(max(self._prefetch + 1, int(self._prefetch * self.INCREASE_FACTOR)))
+
+        return self._prefetch
+
+    def _clamp(self, prefetch: int) -> int:
+        return max(self._min_prefetch, min(self._max_prefetch, prefetch))
@@ -0,0 +1,161 @@
+"""
+Topic routing index. Resolves routing keys to the subscribers, bound with AMQP-style patterns.
+
+Patterns are dot-separated words, where ``*`` matches exactly one word and ``#`` matches zero or more words.
+Patterns are compiled into a trie, so lookup cost depends on the routing key length rather than on the
+number of bindings. Resolved routing keys are kept in a bounded LRU cache.
+
+Usage::
+
+    index = RoutingIndex()
+    index.add("video.*.created", subscriber_one)
+    index.add("video.#", subscriber_two)
+    index.match("video.hd.created")  # (subscriber_one, subscriber_two) in any order
+"""
+
+from collections import OrderedDict
+from typing import AnyStr, Hashable, Set, Tuple
+
+
+__all__ = ("RoutingIndex", )
+
+
+class _Node(object):
+
+    __slots__ = ("children", "values", "is_multi_word")
+
+    def __init__(self, is_multi_word: bool = False):
+        self.children = {}
+        self.values = None
+        self.is_multi_word = is_multi_word
+
+
+class RoutingIndex(object):
+
+    WORD_SEPARATOR = "."
+    SINGLE_WORD_WILDCARD = "*"
+    MULTI_WORD_WILDCARD = "#"
+    DEFAULT_CACHE_SIZE = 4096
+
+    def __init__(self, cache_size: int = DEFAULT_CACHE_SIZE):
+        self._root = _Node()
+        self._patterns = {}
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+
+    def __len__(self):
+        return len(self._patterns)
+
+    def __contains__(self, pattern: AnyStr) -> bool:
+        return pattern in self._patterns
+
+    @property
+    def patterns(self) -> Tuple[AnyStr, ...]:
+        return tuple(self._patterns.keys())
+
+    def subscribers(self, pattern: AnyStr) -> Set:
+        """
+        Values bound with exactly this pattern. No wildcard resolution is performed here.
+        """
+        return set(self._patterns.get(pattern, ()))
+
+    def add(self, pattern: AnyStr, value: Hashable) -> None:
+        node = self._root
+        for word in pattern.split(self.WORD_SEPARATOR):
+            child = node.children.get(word)
+            if child is None:
+                child = _Node(is_multi_word=(word == self.MULTI_WORD_WILDCARD))
+                node.children[word] = child
+            node = child
+
+        if node.values is None:
+            node.values = set()
+            self._patterns[pattern] = node.values
+        node.values.add(value)
+        self._cache.clear()
+
+    def discard(self, pattern: AnyStr, value: Hashable) -> None:
+        values = self._patterns.get(pattern)
+        if values is None:
+            return
+        values.discard(value)
+        if not values:
+            self._remove_pattern(pattern)
+        self._cache.clear()
+
+    def clear(self) -> None:
+        self._root = _Node()
+        self._patterns.clear()
+        self._cache.clear()
+
+    def match(self, routing_key: AnyStr) -> Tuple:
+        """
+        Get all values, which patterns match given routing key.
+
+        :param routing_key: Routing key of the incoming message.
+        :return: Tuple of every matched value. Each value is returned once, even if several patterns matched.
+        """
+        try:
+            result = self._cache[routing_key]
+        except KeyError:
+            pass
+        else:
+            self._cache.move_to_end(routing_key)
+            return result
+
+        result = self._lookup(routing_key.split(self.WORD_SEPARATOR))
+        self._cache[routing_key] = result
+        if len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+        return result
+
+    def _lookup(self, words) -> Tuple:
+        words_count = len(words)
+        matched = OrderedDict()
+        visited = set()
+        stack = [(self._root, 0)]
+
+        while stack:
+            node, position = stack.pop()
+            state = (id(node), position)
+            if state in visited:
+                continue
+            visited.add(state)
+
+            multi = node.children.get(self.MULTI_WORD_WILDCARD)
+            if multi is not None:
+                # ``#`` may match zero words
+                stack.append((multi, position))
+
+            if position == words_count:
+                if node.values:
+                    matched.update((value, None) for value in node.values)
+                continue
+
+            if node.is_multi_word:
+                # ``#`` may swallow one more word
+                stack.append((node, position + 1))
+
+            exact = node.children.get(words[position])
+            if exact is not None:
+                stack.append((exact, position + 1))
+
+            single = node.children.get(self.SINGLE_WORD_WILDCARD)
+            if single is not None:
+                stack.append((single, position + 1))
+
+        return tuple(matched.keys())
+
+    def _remove_pattern(self, pattern: AnyStr) -> None:
+        del self._patterns[pattern]
+        path = [self._root]
+        words = pattern.split(self.WORD_SEPARATOR)
+        for word in words:
+            path.append(path[-1].children[word])
+
+        path[-1].values = None
+        for depth in range(len(words), 0, -1):
+            node = path[depth]
+            if node.values or node.children:
+                break
+            del path[depth - 1].children[words[depth - 1]]
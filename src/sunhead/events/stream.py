@@ -7,10 +7,12 @@ You can subscribe to messages from the Stream, organize distributed dequeuing or
 import asyncio
 from importlib import import_module
 import logging
-from typing import Sequence, AnyStr
+import random
+from typing import AnyStr, List, Optional, Sequence
 
 from sunhead.events.abc import AbstractSubscriber, AbstractTransport, SingleConnectionMeta
 from sunhead.events.exceptions import StreamConnectionError
+from sunhead.events.metrics import get_stream_metrics, RECONNECT_ATTEMPTS, RECONNECT_RECOVERY
 from sunhead.periodical import crontab
 from sunhead.events.types import Transferrable
 
@@ -26,15 +28,27 @@ __all__ = ("Stream", "get_stream", "init_stream_from_settings")
 
 class Stream(object):
 
+    # Transport reports lost connection by itself. This periodical check is just a safety net.
     CONNECTION_CHECK_SECS = 20
+    RECONNECT_BACKOFF_BASE_SECS = 0.5
+    RECONNECT_BACKOFF_MAX_SECS = 30
 
     def __init__(self, transport=DEFAULT_TRANSPORT, **transport_init_kwargs):
         self._transport_name = transport
         self._transport_class = self._get_transport_class(self._transport_name)
         self._transport = self._init_transport(self._transport_class, transport_init_kwargs)
+        self._transport.set_disconnect_callback(self._on_disconnect)
         self._reconnecter = crontab(
             "* * * * * */{}".format(self.CONNECTION_CHECK_SECS), func=self._reconnect, start=False)
         self._reconnect_attempts = 0
+        self._reconnecting = None
+        self._disconnected_at = None
+        self._closing = False
+        self._subscribers = []
+
+        metrics = get_stream_metrics()
+        self._reconnect_attempts_counter = metrics.counters[metrics.prefix(RECONNECT_ATTEMPTS)]
+        self._recovery_summary = metrics.summaries[metrics.prefix(RECONNECT_RECOVERY)]
 
     def _get_transport_class(self, transport_name) -> type:
         module_name, class_name = transport_name.rsplit(".", 1)
@@ -64,6 +78,7 @@ class Stream(object):
             await self._transport.connect()
         except StreamConnectionError:
             logger.error("Can't initialize Stream connection", exc_info=True)
+            self._on_disconnect()
         finally:
             self._reconnecter.start()
 
@@ -72,35 +87,114 @@ class Stream(object):
         if self.connected or self._transport.is_connecting:
             return
 
-        logger.info("Trying to reconnect Events Stream")
-        self._reconnect_attempts += 1
-        try:
-            await self.connect()
-        except StreamConnectionError:
-            logger.info("Unsuccessfull attempt to reconnect #%s", self._reconnect_attempts)
-        else:
-            self._reconnect_attempts = 0
+        self._on_disconnect()
+
+    def _on_disconnect(self) -> None:
+        if self._closing:
+            return
+
+        if self._disconnected_at is None:
+            self._disconnected_at = asyncio.get_event_loop().time()
+
+        if self._reconnecting is None or self._reconnecting.done():
+            self._reconnecting = asyncio.ensure_future(self._reconnect_with_backoff())
+
+    async def _reconnect_with_backoff(self) -> None:
+        self._reconnect_attempts = 0
+        attempt = 0
+        unsubscribed = list(self._subscribers)
+        while not self._closing:
+            attempt += 1
+            if not self.connected and not self._transport.is_connecting:
+                logger.info("Trying to reconnect Events Stream")
+                self._reconnect_attempts += 1
+                self._reconnect_attempts_counter.inc()
+                try:
+                    await self._transport.connect()
+                except StreamConnectionError:
+                    logger.info("Unsuccessfull attempt to reconnect #%s", self._reconnect_attempts)
+                else:
+                    # New connection has no consumers, even if some were restored on the previous one
+                    unsubscribed = list(self._subscribers)
+
+            if self.connected:
+                unsubscribed = await self._resubscribe(unsubscribed)
+                if not unsubscribed:
+                    break
+
+            await asyncio.sleep(self._get_backoff_delay(attempt))
+
+        if self._closing:
+            return
+
+        loop = asyncio.get_event_loop()
+        if self._disconnected_at is not None:
+            recovery_secs = loop.time() - self._disconnected_at
+            self._recovery_summary.observe(recovery_secs)
+            logger.info("Stream connection restored in %.2f secs", recovery_secs)
+        self._disconnected_at = None
+        self._reconnect_attempts = 0
+
+    def _get_backoff_delay(self, attempt: int) -> float:
+        delay = min(self.RECONNECT_BACKOFF_MAX_SECS, self.RECONNECT_BACKOFF_BASE_SECS * 2 ** max(attempt - 1, 0))
+        return random.uniform(delay / 2, delay)
+
+    async def _resubscribe(self, subscribers: Sequence[AbstractSubscriber]) -> List[AbstractSubscriber]:
+        """
+        :return: Subscribers, which failed to be restored and must be tried again.
+        """
+        failed = []
+        for subscriber in subscribers:
+            logger.info("Restoring consuming for '%s'", subscriber.name)
+            try:
+                await self._transport.consume_queue(subscriber)
+            except Exception:
+                # Transport may raise whatever its client library does, e.g. on channel closed by broker
+                logger.error("Can't restore consuming for '%s'", subscriber.name, exc_info=True)
+                failed.append(subscriber)
+        return failed
 
     @property
     def connected(self) -> bool:
         return self._transport.connected
 
-    async def publish(self, data: Transferrable, topics: Sequence[AnyStr]) -> None:
-        for topic in topics:
-            # asyncio.ensure_future(self._transport.publish(data, topic))
-            # Here's the deal. If multiple ``publish`` occurs immediately in a cycle,
-            # ensure_future will only happen after all this cycle completes, or there
-            # will be possibility window. So maybe better to use await here?
-            await self._transport.publish(data, topic)
+    async def publish(self, data: Transferrable, topics: Sequence[AnyStr], **publish_kwargs):
+        """
+        Publish message with every given topic.
+
+        :param publish_kwargs: Transport-specific options, e.g. ``trace_id`` for AMQP.
+        :return: Whatever transport's ``publish_many`` returns, e.g. confirmation futures.
+        """
+        return await self._transport.publish_many(data, topics, **publish_kwargs)
+
+    async def call(self, data: Transferrable, topic: AnyStr, timeout: Optional[float] = None) -> Transferrable:
+        """
+        Publish request and wait for the reply of its subscriber.
+
+        :param timeout: Seconds to wait for the reply. Transport default if omitted.
+        :return: Value, returned by the subscriber's ``on_message``.
+        """
+        return await self._transport.call(data, topic, timeout=timeout)
 
     async def subscribe(self, subscriber: AbstractSubscriber, topics: Sequence[AnyStr]) -> None:
         raise NotImplementedError
 
     async def dequeue(self, subscriber: AbstractSubscriber) -> None:
+        if subscriber not in self._subscribers:
+            self._subscribers.append(subscriber)
+
+        if not self.connected:
+            logger.warning("Stream is not connected, '%s' will start consuming on reconnect", subscriber.name)
+            return
+
         await self._transport.consume_queue(subscriber)
 
     async def close(self):
         logger.info("Closing Stream")
+        self._closing = True
+        self._reconnecter.stop()
+        if self._reconnecting is not None:
+            self._reconnecting.cancel()
         await self._transport.close()
 
 
@@ -141,6 +235,36 @@ async def init_stream_from_settings(cfg: dict) -> Stream:
                     "exchange_name": "video_bus",
                     "exchange_type": "topic",
                     "global_qos": None,
+                    "adaptive_qos": False,
+                    "max_qos": 1000,
+                    "target_latency_secs": None,
+                    "max_in_flight": 1,
+                    "ack_mode": "after",
+                    "requeue_on_error": True,
+                    "publisher_confirms": False,
+                    "confirm_timeout_secs": 30,
+                    "publish_channels": 1,
+                    "ack_batch_size": 1,
+                    "outbox_capacity": 0,
+                    "outbox_path": None,
+                    "serializer": "application/json",
+                    "compression": None,
+                    "decode_executor": None,
+                    "rpc_timeout_secs": 30,
+                    "publish_message_ids": False,
+                    "dedup": False,
+                    "dedup_index_path": None,
+                    "compression_threshold": 1024,
+                },
+                "loopback": {
+                    "transport": "sunhead.events.transports.loopback.LoopbackTransport",
+                    "queue_size": 10000,
+                },
+                "filelog": {
+                    "transport": "sunhead.events.transports.filelog.FileLogTransport",
+                    "path": "/var/lib/video/log",
+                    "partitions": 4,
+                    "retry_failed": False,
                 },
                 "kafka": {},
             },
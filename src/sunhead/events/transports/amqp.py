@@ -3,17 +3,32 @@ Use this module members to connect to RabbitMQ instance.
 """
 
 import asyncio
+from functools import partial
 import logging
-from fnmatch import fnmatch
-from typing import AnyStr, Sequence, Optional
+import time
+from typing import AnyStr, List, Sequence, Optional, Tuple
 from uuid import uuid4
 
 import aioamqp
 
 from sunhead.events import exceptions
 from sunhead.events.abc import AbstractTransport, AbstractSubscriber
-from sunhead.events.types import Transferrable
-from sunhead.serializers import JSONSerializer
+from sunhead.events.acks import AckCoalescer
+from sunhead.events.channels import ChannelPool, track_multiple_confirms
+from sunhead.events.compression import Compressor, decompress
+from sunhead.events.decoding import OffloadDecoder
+from sunhead.events.dedup import DedupCache
+from sunhead.events.dispatch import Dispatcher
+from sunhead.events.message import LazyBody, Message
+from sunhead.events.metrics import get_stream_metrics, RPC_LATENCY, PUBLISH_TO_RECEIVE, RECEIVE_TO_ACK
+from sunhead.events.outbox import Outbox
+from sunhead.events.publishing import PublishPipeline
+from sunhead.events.qos import PrefetchController
+from sunhead.events.routing import RoutingIndex
+from sunhead.events.types import Transferrable, Serialized
+from sunhead.serializers import get_serializer
+from sunhead.serializers.registry import DEFAULT_CONTENT_TYPE
+from sunhead.utils import make_executor
 
 logger = logging.getLogger(__name__)
 
@@ -30,6 +45,15 @@ class AMQPClient(AbstractTransport):
 
     DEFAULT_EXCHANGE_NAME = "default_exchange"
     DEFAULT_EXCHANGE_TYPE = "topic"
+    CLOSE_TIMEOUT_SECS = 10
+    OUTBOX_RETRY_SECS = 1
+    DEFAULT_RPC_TIMEOUT_SECS = 30
+    # Derived prefetch is that many messages per in-flight slot, so next messages are at hand
+    PREFETCH_PER_SLOT = 2
+    RPC_ERROR_HEADER = "x-rpc-error"
+    PUBLISHED_AT_HEADER = "x-published-at-ms"
+    TRACE_ID_HEADER = "x-trace-id"
+    ORIGINAL_SIZE_HEADER = "x-original-size"
 
     def __init__(
             self,
@@ -37,6 +61,38 @@ class AMQPClient(AbstractTransport):
             exchange_name: str = DEFAULT_EXCHANGE_NAME,
             exchange_type: str = DEFAULT_EXCHANGE_TYPE,
             global_qos: Optional[int] = None,
+            routing_cache_size: int = RoutingIndex.DEFAULT_CACHE_SIZE,
+            max_in_flight: int = Dispatcher.DEFAULT_MAX_IN_FLIGHT,
+            ack_mode: str = Dispatcher.ACK_AFTER_PROCESSING,
+            requeue_on_error: bool = True,
+            publisher_confirms: bool = False,
+            publish_batch_size: int = PublishPipeline.DEFAULT_BATCH_SIZE,
+            publish_linger_secs: float = PublishPipeline.DEFAULT_LINGER_SECS,
+            max_outstanding_confirms: int = PublishPipeline.DEFAULT_MAX_OUTSTANDING_CONFIRMS,
+            confirm_timeout_secs: float = PublishPipeline.DEFAULT_CONFIRM_TIMEOUT_SECS,
+            publish_channels: int = ChannelPool.DEFAULT_PUBLISH_CHANNELS,
+            ack_batch_size: int = 1,
+            ack_flush_secs: float = AckCoalescer.DEFAULT_FLUSH_SECS,
+            outbox_capacity: int = 0,
+            outbox_path: Optional[str] = None,
+            outbox_segment_size: int = Outbox.DEFAULT_SEGMENT_SIZE,
+            adaptive_qos: bool = False,
+            min_qos: int = 1,
+            max_qos: int = 1000,
+            target_latency_secs: Optional[float] = None,
+            target_utilization: float = PrefetchController.DEFAULT_TARGET_UTILIZATION,
+            compression: Optional[str] = None,
+            compression_threshold: int = Compressor.DEFAULT_THRESHOLD,
+            serializer: str = DEFAULT_CONTENT_TYPE,
+            decode_executor: Optional[str] = None,
+            decode_workers: Optional[int] = None,
+            decode_threshold: int = OffloadDecoder.DEFAULT_THRESHOLD,
+            rpc_timeout_secs: float = DEFAULT_RPC_TIMEOUT_SECS,
+            publish_message_ids: bool = False,
+            dedup: bool = False,
+            dedup_size: int = DedupCache.DEFAULT_MAX_SIZE,
+            dedup_ttl_secs: float = DedupCache.DEFAULT_TTL_SECS,
+            dedup_index_path: Optional[str] = None,
             **kwargs):
 
         """
@@ -52,6 +108,51 @@ class AMQPClient(AbstractTransport):
 
 
         :param connection_parameters: Dict with connection parameters. See above for its format.
+        :param global_qos: Prefetch count, i.e. how many unacknowledged messages broker may send. If omitted,
+            it is derived from in-flight limits of the subscribers, so the queue is not pulled into memory.
+        :param routing_cache_size: How many resolved routing keys to keep in the routing LRU cache.
+        :param max_in_flight: How many messages each subscriber may handle simultaneously by default.
+        :param ack_mode: ``after`` to ack when message is handled, ``early`` to ack right on receive.
+            Early acknowledged messages are not limited by prefetch count, so with slow subscribers
+            they pile up in memory.
+        :param requeue_on_error: Whether message, failed in subscriber, must be returned to the queue.
+            With ``False`` failed messages are dropped, unless the queue has a dead letter exchange.
+            With ``True`` message, which always fails, is redelivered over and over.
+        :param publisher_confirms: Publish in batches through confirm mode. ``publish`` will return future,
+            resolved when broker confirms the message.
+        :param publish_batch_size: Flush publish batch when it has that many messages.
+        :param publish_linger_secs: Flush publish batch when its first message waits that long.
+        :param max_outstanding_confirms: How many published messages may wait for the broker confirmation.
+        :param confirm_timeout_secs: Consider message failed, if broker doesn't confirm it that long.
+        :param publish_channels: How many channels to spread publishes over. Consuming always has its own channel.
+        :param ack_batch_size: Acknowledge up to that many messages with one ``multiple`` ack. 1 disables coalescing.
+        :param ack_flush_secs: Send coalesced acks not later than that.
+        :param outbox_capacity: How many messages, published while disconnected, to keep in memory. 0 disables outbox.
+        :param outbox_path: Segment file to spill outbox messages, which don't fit in memory.
+        :param outbox_segment_size: Size of the outbox segment file in bytes.
+        :param adaptive_qos: Tune prefetch count on the fly, starting with ``global_qos``.
+        :param min_qos: Adaptive prefetch count won't go lower than that.
+        :param max_qos: Adaptive prefetch count won't go higher than that.
+        :param target_latency_secs: Lower prefetch count, when handling a message takes longer than that.
+        :param target_utilization: Raise prefetch count, when that part of it is busy with handlers.
+        :param compression: Codec to compress published messages with, e.g. ``deflate`` or ``lzma``.
+            Received messages are decompressed according to their content encoding regardless of this.
+        :param compression_threshold: Compress only messages of that many bytes or bigger.
+        :param serializer: Content type of published messages, e.g. ``application/msgpack``.
+            Received messages are deserialized according to their content type regardless of this,
+            messages of unknown content type are deserialized with this one.
+        :param decode_executor: ``thread`` or ``process`` to deserialize large messages in the pool of that kind.
+        :param decode_workers: Size of the decoding pool.
+        :param decode_threshold: Decompress and deserialize messages of that many bytes or bigger in the pool.
+            Compressed messages are measured by their original size, when publisher declares it.
+        :param rpc_timeout_secs: How long ``call`` waits for the reply by default.
+        :param publish_message_ids: Give every published message unique ``message_id``, so consumers
+            can tell redelivery from another message with the same body.
+        :param dedup: Skip received messages, which were already handled. Messages are identified by
+            ``message_id``, or by body hash, when they have none.
+        :param dedup_size: How many handled messages to remember in memory.
+        :param dedup_ttl_secs: How long to remember handled message.
+        :param dedup_index_path: File to remember handled messages in, so they survive restart.
         :return: EventsQueueClient instance.
         """
 
@@ -62,23 +163,87 @@ class AMQPClient(AbstractTransport):
         self._connection_parameters = connection_parameters or {}
         self._transport = None
         self._protocol = None
-        self._channel = None
+        self._channels = None
+        self._publish_channels = publish_channels
         self._exchange_name = exchange_name
         self._exchange_type = exchange_type
         self._global_qos = global_qos
-        self._serializer = self._get_serializer()
+        self._derive_qos = global_qos is None and not adaptive_qos
+        self._serializer = get_serializer(serializer)
+        self._deserializers = {self._serializer.CONTENT_TYPE: self._serializer}
         self._is_connecting = False
         self._connection_guid = str(uuid4())
         self._known_queues = {}
-        self._routing = {}
-
-    def _get_serializer(self):
-        # TODO: Make serializer configurable here
-        return JSONSerializer()
+        self._routing = RoutingIndex(cache_size=routing_cache_size)
+        self._dispatcher = Dispatcher(max_in_flight=max_in_flight, ack_mode=ack_mode)
+        self._requeue_on_error = requeue_on_error
+        self._ack_batch_size = ack_batch_size
+        self._ack_flush_secs = ack_flush_secs
+        self._ack_coalescers = {}
+        self._outbox = None
+        if outbox_capacity:
+            self._outbox = Outbox(outbox_capacity, spill_path=outbox_path, segment_size=outbox_segment_size)
+        self._outbox_drainer = None
+        self._publish_message_ids = publish_message_ids
+        self._dedup = None
+        if dedup:
+            self._dedup = DedupCache(max_size=dedup_size, ttl_secs=dedup_ttl_secs, index_path=dedup_index_path)
+        self._rpc_timeout_secs = rpc_timeout_secs
+        self._rpc_calls = {}
+        self._reply_queue = None
+        self._reply_queue_lock = asyncio.Lock()
+        metrics = get_stream_metrics()
+        self._rpc_latency_histogram = metrics.histograms[metrics.prefix(RPC_LATENCY)]
+        self._publish_to_receive_histogram = metrics.histograms[metrics.prefix(PUBLISH_TO_RECEIVE)]
+        self._receive_to_ack_histogram = metrics.histograms[metrics.prefix(RECEIVE_TO_ACK)]
+        self._decoder = None
+        if decode_executor:
+            self._decoder = OffloadDecoder(
+                make_executor(decode_executor, max_workers=decode_workers), threshold=decode_threshold)
+        self._compressor = None
+        if compression:
+            self._compressor = Compressor(compression, threshold=compression_threshold)
+        self._qos_controller = None
+        if adaptive_qos:
+            self._qos_controller = PrefetchController(
+                self._dispatcher,
+                self._apply_qos,
+                min_prefetch=min_qos,
+                max_prefetch=max_qos,
+                initial_prefetch=global_qos,
+                target_latency_secs=target_latency_secs,
+                target_utilization=target_utilization,
+            )
+            self._global_qos = self._qos_controller.prefetch
+        self._publish_pipeline = None
+        if publisher_confirms:
+            self._publish_pipeline = PublishPipeline(
+                self._publish_body,
+                batch_size=publish_batch_size,
+                linger_secs=publish_linger_secs,
+                max_outstanding_confirms=max_outstanding_confirms,
+                confirm_timeout_secs=confirm_timeout_secs,
+            )
+
+    def _get_deserializer(self, content_type: Optional[str]):
+        if not content_type:
+            return self._serializer
+
+        serializer = self._deserializers.get(content_type)
+        if serializer is None:
+            try:
+                serializer = get_serializer(content_type)
+            except (LookupError, ImportError):
+                # Publisher may mark messages with any content type, so they are given a chance with our own
+                logger.warning(
+                    "No serializer for content type '%s', using '%s'", content_type, self._serializer.CONTENT_TYPE)
+                serializer = self._serializer
+            self._deserializers[content_type] = serializer
+        return serializer
 
     @property
     def connected(self):
-        return self._channel is not None and self._channel.is_open
+        return self._channels is not None and self._channels.is_open
 
     @property
     def is_connecting(self) -> bool:
@@ -97,19 +262,25 @@ class AMQPClient(AbstractTransport):
             return
 
         self._is_connecting = True
+        if self._channels is not None:
+            # Connection is still up, but its consume channel can't be reopened
+            self._channels.abandon()
+            self._channels = None
+            self._transport.close()
+        self._reset_consumers()
         try:
             logger.info("Connecting to RabbitMQ...")
-            self._transport, self._protocol = await aioamqp.connect(**self._connection_parameters)
-
-            logger.info("Getting channel...")
-            self._channel = await self._protocol.channel()
+            self._transport, self._protocol = await aioamqp.connect(
+                on_error=self._on_connection_error, **self._connection_parameters)
 
-            if self._global_qos is not None:
-                logger.info("Setting prefetch count on connection (%s)", self._global_qos)
-                await self._channel.basic_qos(0, self._global_qos, 1)
+            logger.info("Getting channels...")
+            self._channels = ChannelPool(
+                self._protocol, publish_channels=self._publish_channels, on_open=self._setup_channel)
+            await self._channels.open()
 
             logger.info("Connecting to exchange '%s (%s)'", self._exchange_name, self._exchange_type)
-            await self._channel.exchange(self._exchange_name, self._exchange_type)
+            channel = await self._channels.get_consume_channel()
+            await channel.exchange(self._exchange_name, self._exchange_type)
 
         except (aioamqp.AmqpClosedConnection, Exception):
             logger.error("Error initializing RabbitMQ connection", exc_info=True)
@@ -118,25 +289,297 @@ class AMQPClient(AbstractTransport):
 
         self._is_connecting = False
 
+        if self._qos_controller is not None:
+            self._qos_controller.start()
+
+        self._start_outbox_draining()
+
+    async def _setup_channel(self, channel, purpose: str) -> None:
+        if purpose == ChannelPool.PURPOSE_CONSUME and self._global_qos is not None:
+            logger.info("Setting prefetch count on channel (%s)", self._global_qos)
+            await channel.basic_qos(0, self._global_qos, 1)
+
+        if purpose == ChannelPool.PURPOSE_CONSUME and self._known_queues:
+            # Consume channel was reopened, while connection is still alive. Queues and bindings are in place.
+            for queue_name in self._known_queues:
+                logger.info("Restoring consumer of queue '%s'", queue_name)
+                await channel.basic_consume(callback=self._on_message, queue_name=queue_name)
+
+        if purpose == ChannelPool.PURPOSE_REPLY and self._reply_queue is not None:
+            # Exclusive queue lives as long as connection does, so only consumer must be restored
+            logger.info("Restoring consumer of reply queue")
+            await channel.basic_consume(callback=self._on_reply, queue_name=self._reply_queue, no_ack=True)
+
+        if purpose == ChannelPool.PURPOSE_PUBLISH and self._publish_pipeline is not None:
+            logger.info("Enabling publisher confirms")
+            await channel.confirm_select()
+            track_multiple_confirms(channel)
+
+    async def _apply_qos(self, prefetch: int) -> None:
+        self._global_qos = prefetch
+        if self.connected:
+            channel = await self._channels.get_consume_channel()
+            await channel.basic_qos(0, prefetch, 1)
+
+    def _on_connection_error(self, exception) -> None:
+        if self._is_connecting:
+            return
+        logger.error("RabbitMQ connection lost: %r", exception)
+        if self._channels is not None:
+            self._channels.abandon()
+        self._channels = None
+        self._fail_rpc_calls()
+        self._notify_disconnected()
+
+    def _reset_consumers(self) -> None:
+        # New connection has no consumers, whatever was consumed before
+        self._known_queues.clear()
+        self._routing.clear()
+        self._ack_coalescers.clear()
+        self._reply_queue = None
+        self._fail_rpc_calls()
+
     async def close(self):
-        self._protocol.stop()
-        await self._channel.close()
+        if self._qos_controller is not None:
+            self._qos_controller.stop()
+        if self._publish_pipeline is not None:
+            await self._publish_pipeline.flush(timeout=self.CLOSE_TIMEOUT_SECS)
+        await self._dispatcher.join(timeout=self.CLOSE_TIMEOUT_SECS)
+        for coalescer in self._ack_coalescers.values():
+            if coalescer.channel.is_open:
+                await coalescer.flush()
+        if self._protocol is not None:
+            self._protocol.stop()
+        if self._channels is not None:
+            await self._channels.close()
+        if self._outbox is not None:
+            self._outbox.close()
+        if self._decoder is not None:
+            self._decoder.close()
+        if self._dedup is not None:
+            self._dedup.close()
+
+    async def publish(
+            self,
+            data: Transferrable,
+            topic: AnyStr,
+            trace_id: Optional[str] = None,
+            **kwargs) -> Optional[asyncio.Future]:
+        """
+        Publish message to the exchange.
 
-    async def publish(self, data: Transferrable, topic: AnyStr) -> None:
-        if not self.connected:
+        :param trace_id: Passed to consumers in ``x-trace-id`` header.
+        :return: With publisher confirms enabled, future which is resolved when broker confirms the message.
+            Otherwise does not return anything.
+        """
+        futures = await self.publish_many(data, (topic, ), trace_id=trace_id)
+        return futures[0] if futures else None
+
+    async def publish_many(
+            self,
+            data: Transferrable,
+            topics: Sequence[AnyStr],
+            trace_id: Optional[str] = None,
+            **kwargs) -> Optional[List[asyncio.Future]]:
+        """
+        Publish the same message with several routing keys. Message is serialized only once
+        and sent with every routing key without waiting for the previous one.
+
+        :param trace_id: Passed to consumers in ``x-trace-id`` header. Not kept for messages, which go to outbox.
+        :return: With publisher confirms enabled, futures for every routing key, resolved when broker
+            confirms the message. Otherwise does not return anything.
+        """
+        if not self.connected and self._outbox is None:
             logger.warning("Attempted to send message while not connected")
             return
 
-        body = self._serializer.serialize(data)
+        body = self._serializer.serialize_bytes(data)
+
+        # Outbox must be drained first to keep the publish order
+        if self._outbox is not None and (not self.connected or len(self._outbox)):
+            for topic in topics:
+                self._outbox.put(body, topic)
+            self._start_outbox_draining()
+            return
+
+        body, properties = self._encode_body(body, trace_id=trace_id)
+        # Deliveries with different routing keys are different messages, not duplicates
+        topic_properties = [self._renew_message_id(properties) for _ in topics]
+
+        if self._publish_pipeline is not None:
+            return [
+                self._publish_pipeline.submit(body, topic, properties)
+                for topic, properties in zip(topics, topic_properties)
+            ]
+
+        await asyncio.gather(*(
+            self._publish_body(body, topic, properties) for topic, properties in zip(topics, topic_properties)))
+
+    async def _send(self, body: Serialized, topic: AnyStr, published_at: float) -> Optional[asyncio.Future]:
+        body, properties = self._encode_body(body, published_at=published_at)
+        if self._publish_pipeline is not None:
+            return self._publish_pipeline.submit(body, topic, properties)
+
+        await self._publish_body(body, topic, properties)
+
+    def _encode_body(
+            self,
+            body: Serialized,
+            trace_id: Optional[str] = None,
+            published_at: Optional[float] = None) -> Tuple[Serialized, dict]:
+        if published_at is None:
+            published_at = time.time()
+        # aioamqp writes every int header as 32-bit unsigned, which milliseconds since epoch overflow
+        headers = {self.PUBLISHED_AT_HEADER: str(int(published_at * 1000))}
+        if trace_id is not None:
+            headers[self.TRACE_ID_HEADER] = trace_id
+        properties = {
+            "content_type": self._serializer.CONTENT_TYPE,
+            "timestamp": int(published_at),
+            "headers": headers,
+        }
+        if self._publish_message_ids:
+            properties["message_id"] = uuid4().hex
+        if self._compressor is not None:
+            original_size = len(body)
+            body, encoding = self._compressor.compress(body)
+            if encoding is not None:
+                properties["content_encoding"] = encoding
+                # Lets consumer decide whether to decompress the body off the loop
+                headers[self.ORIGINAL_SIZE_HEADER] = str(original_size)
+        return body, properties
+
+    def _renew_message_id(self, properties: dict) -> dict:
+        if "message_id" not in properties:
+            return properties
+        return dict(properties, message_id=uuid4().hex)
+
+    def _start_outbox_draining(self) -> None:
+        if self._outbox is None or not len(self._outbox) or not self.connected:
+            return
+        if self._outbox_drainer is not None and not self._outbox_drainer.done():
+            return
+        self._outbox_drainer = asyncio.ensure_future(self._drain_outbox())
+
+    async def _drain_outbox(self) -> None:
+        logger.info("Draining outbox, %s messages", len(self._outbox))
+        while len(self._outbox) and self.connected:
+            body, topic, published_at = self._outbox.peek()
+            try:
+                confirmation = await self._send(body, topic, published_at)
+                if confirmation is not None:
+                    # Message leaves outbox only when broker has it, otherwise it is sent again
+                    await confirmation
+            except Exception:
+                logger.warning("Outbox draining interrupted, %s messages left", len(self._outbox), exc_info=True)
+                # Connection may be still alive, so publishes would keep going to outbox with nobody to drain it
+                asyncio.get_event_loop().call_later(self.OUTBOX_RETRY_SECS, self._start_outbox_draining)
+                return
+            self._outbox.pop()
+
+    async def _publish_body(
+            self,
+            body: Serialized,
+            topic: AnyStr,
+            properties: Optional[dict] = None,
+            exchange_name: Optional[str] = None) -> None:
+        if not self.connected:
+            raise exceptions.PublisherError("Channel closed before message was published")
 
-        await self._channel.publish(
+        channel = await self._channels.get_publish_channel()
+        await channel.publish(
             body,
-            exchange_name=self._exchange_name,
-            routing_key=topic
+            exchange_name=self._exchange_name if exchange_name is None else exchange_name,
+            routing_key=topic,
+            properties=properties,
         )
         # Uncomment for debugging
         # logger.debug("Published message to AMQP exchange=%s, topic=%s", self._exchange_name, topic)
 
+    async def call(self, data: Transferrable, topic: AnyStr, timeout: Optional[float] = None) -> Transferrable:
+        """
+        Publish request and wait for the reply. Replies come to the exclusive queue of this connection
+        and are matched to requests by correlation id, so any number of calls may wait at once.
+
+        :param timeout: Seconds to wait for the reply. ``rpc_timeout_secs`` if omitted.
+        :return: Value, returned by the subscriber's ``on_message``.
+        :raises asyncio.TimeoutError: When reply didn't come in time.
+        :raises RPCError: When subscriber failed to handle the request.
+        """
+        if not self.connected:
+            raise exceptions.PublisherError("Can't call '%s' while not connected" % topic)
+
+        reply_queue = await self._get_reply_queue()
+        body, properties = self._encode_body(self._serializer.serialize_bytes(data))
+        correlation_id = uuid4().hex
+        properties["reply_to"] = reply_queue
+        properties["correlation_id"] = correlation_id
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._rpc_calls[correlation_id] = future
+        started_at = loop.time()
+        try:
+            await self._publish_body(body, topic, properties)
+            return await asyncio.wait_for(future, timeout or self._rpc_timeout_secs)
+        finally:
+            self._rpc_calls.pop(correlation_id, None)
+            self._rpc_latency_histogram.labels(topic).observe(loop.time() - started_at)
+
+    async def _get_reply_queue(self) -> str:
+        if self._reply_queue is not None:
+            return self._reply_queue
+
+        async with self._reply_queue_lock:
+            if self._reply_queue is None:
+                channel = await self._channels.get_reply_channel()
+                declaration = await channel.queue_declare("", exclusive=True)
+                reply_queue = declaration.get("queue")
+                await channel.basic_consume(callback=self._on_reply, queue_name=reply_queue, no_ack=True)
+                logger.info("Consuming reply queue '%s'", reply_queue)
+                self._reply_queue = reply_queue
+        return self._reply_queue
+
+    async def _on_reply(self, channel, body, envelope, properties) -> None:
+        future = self._rpc_calls.get(properties.correlation_id)
+        if future is None or future.done():
+            logger.warning("Reply to unknown or expired call '%s'", properties.correlation_id)
+            return
+
+        error = (properties.headers or {}).get(self.RPC_ERROR_HEADER)
+        if error is not None:
+            future.set_exception(exceptions.RPCError(error))
+            return
+
+        try:
+            body = decompress(body, properties.content_encoding)
+            data = self._get_deserializer(properties.content_type).deserialize(body)
+        except Exception as e:
+            future.set_exception(e)
+            return
+
+        future.set_result(data)
+
+    async def _reply(self, reply_to: str, correlation_id: str, result: Transferrable, error: Exception) -> None:
+        properties = {"correlation_id": correlation_id}
+        if error is not None:
+            error_text = "{}: {}".format(error.__class__.__name__, error)
+            # aioamqp refuses to publish empty payload, so the error text goes into the body as well
+            body = error_text.encode("utf-8")
+            properties["content_type"] = "text/plain"
+            properties["headers"] = {self.RPC_ERROR_HEADER: error_text}
+        else:
+            body, encoded_properties = self._encode_body(self._serializer.serialize_bytes(result))
+            properties.update(encoded_properties)
+
+        # Reply goes straight to the caller's queue through the default exchange
+        await self._publish_body(body, reply_to, properties, exchange_name="")
+
+    def _fail_rpc_calls(self) -> None:
+        for future in self._rpc_calls.values():
+            if not future.done():
+                future.set_exception(exceptions.StreamConnectionError("Connection lost before reply"))
+
     async def consume_queue(self, subscriber: AbstractSubscriber) -> None:
 
         """
@@ -154,25 +597,35 @@ class AMQPClient(AbstractTransport):
 
         await self._declare_queue(queue_name)
 
-        # TODO: There is a lot of room to improvement here. Figure out routing done the right way
         for key in topics:
-            self._routing.setdefault(key, set())
-            if subscriber in self._routing[key]:
-                logger.warning("Subscriber '%s' already receiving routing_key '%s'", subscriber, key)
-                break
+            # Binding is idempotent, so failed attempt to consume may be simply repeated
             await self._bind_key_to_queue(key, queue_name)
-            self._routing[key].add(subscriber)
+            if subscriber not in self._routing.subscribers(key):
+                self._routing.add(key, subscriber)
+
+        if self._derive_qos:
+            await self._apply_qos(self._derive_prefetch(subscriber))
 
         logger.info("Consuming queue '%s'", queue_name)
+        channel = await self._channels.get_consume_channel()
         await asyncio.wait_for(
-            self._channel.basic_consume(callback=self._on_message, queue_name=queue_name),
+            channel.basic_consume(callback=self._on_message, queue_name=queue_name),
             timeout=10
         )
-        self._add_to_known_queue(queue_name)
+        self._add_to_known_queue(queue_name, subscriber)
+
+    def _derive_prefetch(self, new_subscriber: AbstractSubscriber) -> int:
+        subscribers = [queue["subscriber"] for queue in self._known_queues.values()] + [new_subscriber]
+        slots = 0
+        for subscriber in subscribers:
+            in_flight = getattr(subscriber, "MAX_IN_FLIGHT", None) or self._dispatcher.max_in_flight
+            slots += in_flight * (getattr(subscriber, "BATCH_SIZE", None) or 1)
+        return slots * self.PREFETCH_PER_SLOT
 
     async def _declare_queue(self, queue_name: AnyStr) -> None:
         logger.info("Declaring queue...")
-        queue_declaration = await self._channel.queue_declare(queue_name)
+        channel = await self._channels.get_consume_channel()
+        queue_declaration = await channel.queue_declare(queue_name)
         queue_name = queue_declaration.get("queue")
         logger.info("Declared queue '%s'", queue_name)
 
@@ -186,7 +639,8 @@ class AMQPClient(AbstractTransport):
         """
         logger.info("Binding key='%s'", routing_key)
 
-        result = await self._channel.queue_bind(
+        channel = await self._channels.get_consume_channel()
+        result = await channel.queue_bind(
             exchange_name=self._exchange_name,
             queue_name=queue_name,
             routing_key=routing_key,
@@ -205,26 +659,150 @@ class AMQPClient(AbstractTransport):
         :return: Coroutine object with result of message handling operation
         """
 
+        received_at = time.time()
+        settle = partial(self._settle, channel, envelope.delivery_tag)
+
         subscribers = self._get_subscribers(envelope.routing_key)
         if not subscribers:
             logger.debug("No route for message with key '%s'", envelope.routing_key)
+            await settle(True)
             return
 
-        body = self._serializer.deserialize(body)
+        self._observe_publish_to_receive(envelope.routing_key, properties, received_at)
+        settle = partial(self._settle_timed, settle, envelope.routing_key, received_at)
+
+        if self._dedup is not None:
+            dedup_key = self._dedup.get_key(
+                getattr(properties, "message_id", None),
+                body,
+                routing_key=envelope.routing_key,
+                consumer=",".join(subscriber.name for subscriber in subscribers),
+            )
+            if not self._dedup.claim(dedup_key):
+                logger.debug("Skipping duplicate message with key '%s'", envelope.routing_key)
+                await settle(True)
+                return
+            settle = partial(self._settle_claimed, settle, dedup_key)
+
+        encoding = getattr(properties, "content_encoding", None)
+        offload = self._decoder is not None and self._decoder.should_offload(self._get_body_size(body, properties))
+        if not offload:
+            try:
+                body = decompress(body, encoding)
+            except exceptions.SerializationError:
+                logger.error("Dropping message with key '%s'", envelope.routing_key, exc_info=True)
+                # Undecodable message won't get any better, so it is never requeued
+                await settle(False, requeue=False)
+                return
+        serializer = self._get_deserializer(getattr(properties, "content_type", None))
+
+        message = Message.acquire(
+            # Deserialized on demand, only if some subscriber needs it
+            LazyBody(body, serializer),
+            envelope.routing_key,
+            properties=properties,
+            delivery_tag=envelope.delivery_tag,
+            redelivered=envelope.is_redeliver,
+            received_at=received_at,
+        )
 
-        for subscriber in subscribers:
-            # Check later if ensure_future can be applied here
-            await subscriber.on_message(body, envelope.routing_key)
+        reply = None
+        if getattr(properties, "reply_to", None):
+            reply = partial(self._reply, properties.reply_to, properties.correlation_id)
+
+        deserialize = not all(subscriber.RAW_DELIVERY for subscriber in subscribers)
+        if offload and (encoding or deserialize):
+            # Small messages, received meanwhile, are dispatched without waiting for this one
+            asyncio.ensure_future(
+                self._decode_and_dispatch(subscribers, message, serializer, settle, reply, encoding, deserialize))
+            return
+
+        self._dispatcher.dispatch(subscribers, message, envelope.routing_key, settle, reply)
+
+    def _get_body_size(self, body: bytes, properties) -> int:
+        original_size = (getattr(properties, "headers", None) or {}).get(self.ORIGINAL_SIZE_HEADER)
+        try:
+            return max(len(body), int(original_size or 0))
+        except ValueError:
+            logger.debug("Malformed '%s' header: %r", self.ORIGINAL_SIZE_HEADER, original_size)
+            return len(body)
+
+    async def _decode_and_dispatch(
+            self, subscribers, message: Message, serializer, settle, reply, encoding, deserialize) -> None:
+        try:
+            message.body = await self._decoder.decode(message.body, serializer, encoding, deserialize)
+        except Exception:
+            logger.error("Dropping message with key '%s'", message.routing_key, exc_info=True)
+            await settle(False, requeue=False)
+            return
 
-        await self._channel.basic_client_ack(envelope.delivery_tag)
+        self._dispatcher.dispatch(subscribers, message, message.routing_key, settle, reply)
+
+    async def _settle(self, channel, delivery_tag: int, succeeded: bool, requeue: Optional[bool] = None) -> None:
+        if requeue is None:
+            requeue = self._requeue_on_error
+
+        coalescer = self._get_ack_coalescer(channel)
+        if coalescer is not None:
+            if succeeded:
+                await coalescer.ack(delivery_tag)
+            else:
+                await coalescer.nack(delivery_tag, requeue=requeue)
+            return
+
+        if succeeded:
+            await channel.basic_client_ack(delivery_tag)
+        else:
+            await channel.basic_client_nack(delivery_tag, requeue=requeue)
+
+    async def _settle_timed(
+            self,
+            settle,
+            routing_key: AnyStr,
+            received_at: float,
+            succeeded: bool,
+            requeue: Optional[bool] = None) -> None:
+        await settle(succeeded, requeue=requeue)
+        if succeeded:
+            self._receive_to_ack_histogram.labels(routing_key).observe(time.time() - received_at)
+
+    def _observe_publish_to_receive(self, routing_key: AnyStr, properties, received_at: float) -> None:
+        published_at_ms = (getattr(properties, "headers", None) or {}).get(self.PUBLISHED_AT_HEADER)
+        if published_at_ms is None:
+            return
+        try:
+            published_at = int(published_at_ms) / 1000
+        except ValueError:
+            logger.debug("Malformed '%s' header: %r", self.PUBLISHED_AT_HEADER, published_at_ms)
+            return
+        # Clocks of publisher and consumer hosts are never perfectly in sync
+        latency = max(received_at - published_at, 0)
+        self._publish_to_receive_histogram.labels(routing_key).observe(latency)
+
+    async def _settle_claimed(
+            self, settle, dedup_key: bytes, succeeded: bool, requeue: Optional[bool] = None) -> None:
+        if succeeded:
+            self._dedup.commit(dedup_key)
+        else:
+            self._dedup.release(dedup_key)
+        await settle(succeeded, requeue=requeue)
+
+    def _get_ack_coalescer(self, channel) -> Optional[AckCoalescer]:
+        if self._ack_batch_size <= 1:
+            return None
+
+        # Delivery tags start over on reopened channel, so does the coalescer
+        coalescer = self._ack_coalescers.get(channel.channel_id)
+        if coalescer is None or coalescer.channel is not channel:
+            coalescer = AckCoalescer(channel, max_pending=self._ack_batch_size, flush_secs=self._ack_flush_secs)
+            self._ack_coalescers[channel.channel_id] = coalescer
+        return coalescer
 
     def _get_subscribers(self, incoming_routing_key: AnyStr) -> Sequence[AbstractSubscriber]:
-        for key, subscribers in self._routing.items():
-            if fnmatch(incoming_routing_key, key):
-                return subscribers
-        return tuple()
+        return self._routing.match(incoming_routing_key)
 
-    def _add_to_known_queue(self, queue_name: AnyStr) -> None:
+    def _add_to_known_queue(self, queue_name: AnyStr, subscriber: AbstractSubscriber) -> None:
         self._known_queues[queue_name] = {
             "bound_keys": set(),
+            "subscriber": subscriber,
         }
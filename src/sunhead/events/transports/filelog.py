@@ -0,0 +1,572 @@
+"""
+Local append-only log transport. Kafka-like semantics without any broker.
+
+Every topic is split into partitions, every partition is a directory of memory-mapped segment files,
+named after the offset of their first record. Messages are appended sequentially, partition is chosen
+by key hash, or round-robin when there is no key.
+
+Subscriber's name is a consumer group. Group reads every partition of the requested topics and commits
+offsets, so reading continues from where it stopped, even after restart. Group may be moved to any offset
+with ``seek`` to replay the log. Up to the subscriber's in-flight capacity of records is handled at once,
+committed offset is the one after the last record, handled along with all the preceding ones.
+
+Only one process may write to the log directory at once. Other processes may read it, new records are
+picked up when readers poll. Every group keeps offsets in its own file and is consumed by one process only,
+the group file is locked while it is consumed. So several worker processes must use different groups.
+
+Message, failed in subscriber, is skipped by default, so it does not block its partition forever.
+With ``retry_failed`` it is handled again and again until it succeeds.
+
+Usage::
+
+    stream = Stream(
+        transport="sunhead.events.transports.filelog.FileLogTransport",
+        path="/var/lib/myapp/log",
+        partitions=4,
+    )
+"""
+
+import asyncio
+from bisect import bisect_right
+from collections import deque
+import fcntl
+from functools import partial
+from itertools import count
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import AnyStr, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import quote
+from zlib import crc32
+
+from sunhead.events import exceptions
+from sunhead.events.abc import AbstractTransport, AbstractSubscriber
+from sunhead.events.dispatch import Dispatcher
+from sunhead.events.message import LazyBody, Message
+from sunhead.events.types import Transferrable
+from sunhead.serializers import get_serializer
+from sunhead.serializers.registry import DEFAULT_CONTENT_TYPE
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("FileLogTransport", )
+
+
+class LogSegment(object):
+
+    FILE_SUFFIX = ".log"
+    RECORD_HEADER = struct.Struct(">II")
+
+    def __init__(self, path: str, base_offset: int, size: int):
+        exists = os.path.isfile(path)
+        self._path = path
+        self._base_offset = base_offset
+        self._file = open(path, "r+b" if exists else "w+b")
+        self._size = max(size, os.path.getsize(path))
+        if os.path.getsize(path) < self._size:
+            self._file.truncate(self._size)
+        self._mmap = mmap.mmap(self._file.fileno(), self._size)
+        self._positions = []
+        self._write_position = 0
+        if exists:
+            self._scan()
+
+    @classmethod
+    def get_filename(cls, base_offset: int) -> str:
+        return "{:020d}{}".format(base_offset, cls.FILE_SUFFIX)
+
+    @property
+    def base_offset(self) -> int:
+        return self._base_offset
+
+    @property
+    def next_offset(self) -> int:
+        return self._base_offset + len(self._positions)
+
+    def append(self, body: bytes) -> Optional[int]:
+        """
+        :return: Offset of the appended record or ``None`` if there is no room for it in the segment.
+        """
+        position = self._write_position
+        record_end = position + self.RECORD_HEADER.size + len(body)
+        if record_end > self._size:
+            return None
+
+        self.RECORD_HEADER.pack_into(self._mmap, position, len(body), crc32(body))
+        self._mmap[position + self.RECORD_HEADER.size:record_end] = body
+        self._positions.append(position)
+        self._write_position = record_end
+        return self.next_offset - 1
+
+    def read(self, offset: int) -> bytes:
+        position = self._positions[offset - self._base_offset]
+        length, _ = self.RECORD_HEADER.unpack_from(self._mmap, position)
+        start = position + self.RECORD_HEADER.size
+        return self._mmap[start:start + length]
+
+    def refresh(self) -> None:
+        """
+        Pick up records, appended to the segment by another process.
+        """
+        self._scan(quiet=True)
+
+    def flush(self) -> None:
+        self._mmap.flush()
+
+    def close(self) -> None:
+        self._mmap.flush()
+        self._mmap.close()
+        self._file.close()
+
+    def _scan(self, quiet: bool = False) -> None:
+        position = self._write_position
+        while position + self.RECORD_HEADER.size <= self._size:
+            length, checksum = self.RECORD_HEADER.unpack_from(self._mmap, position)
+            if not length:
+                break
+            start = position + self.RECORD_HEADER.size
+            body = self._mmap[start:start + length]
+            if len(body) < length or crc32(body) != checksum:
+                # When refreshing, record is most likely being written right now
+                if not quiet:
+                    logger.warning("Broken record at position %s of '%s', ignoring the rest", position, self._path)
+                break
+            self._positions.append(position)
+            position = start + length
+        self._write_position = position
+
+
+class LogPartition(object):
+
+    def __init__(self, path: str, segment_size: int):
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._segment_size = segment_size
+        filenames = sorted(name for name in os.listdir(path) if name.endswith(LogSegment.FILE_SUFFIX))
+        self._segments = [
+            LogSegment(os.path.join(path, name), int(name[:-len(LogSegment.FILE_SUFFIX)]), segment_size)
+            for name in filenames
+        ]
+        if not self._segments:
+            self._roll(0)
+        self._base_offsets = [segment.base_offset for segment in self._segments]
+        self._appended = asyncio.Event()
+
+    @property
+    def start_offset(self) -> int:
+        return self._segments[0].base_offset
+
+    @property
+    def end_offset(self) -> int:
+        return self._segments[-1].next_offset
+
+    def append(self, body: bytes) -> int:
+        offset = self._segments[-1].append(body)
+        if offset is None:
+            self._roll(self.end_offset)
+            offset = self._segments[-1].append(body)
+            if offset is None:
+                raise exceptions.PublisherError("Message of %s bytes does not fit into log segment" % len(body))
+
+        # Wake up the readers, waiting for the new records
+        self._appended.set()
+        self._appended.clear()
+        return offset
+
+    def read(self, offset: int, limit: int) -> List[Tuple[int, bytes]]:
+        offset = max(offset, self.start_offset)
+        end = min(offset + limit, self.end_offset)
+        records = []
+        for record_offset in range(offset, end):
+            segment = self._segments[bisect_right(self._base_offsets, record_offset) - 1]
+            records.append((record_offset, segment.read(record_offset)))
+        return records
+
+    async def wait(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self._appended.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def refresh(self) -> None:
+        """
+        Pick up records and segments, appended to the partition by another process.
+        """
+        self._segments[-1].refresh()
+        last_base_offset = self._segments[-1].base_offset
+        base_offsets = sorted(
+            int(name[:-len(LogSegment.FILE_SUFFIX)])
+            for name in os.listdir(self._path) if name.endswith(LogSegment.FILE_SUFFIX)
+        )
+        for base_offset in base_offsets:
+            if base_offset > last_base_offset:
+                path = os.path.join(self._path, LogSegment.get_filename(base_offset))
+                self._segments.append(LogSegment(path, base_offset, self._segment_size))
+        self._base_offsets = [segment.base_offset for segment in self._segments]
+
+    def flush(self) -> None:
+        self._segments[-1].flush()
+
+    def close(self) -> None:
+        for segment in self._segments:
+            segment.close()
+
+    def _roll(self, base_offset: int) -> None:
+        path = os.path.join(self._path, LogSegment.get_filename(base_offset))
+        self._segments.append(LogSegment(path, base_offset, self._segment_size))
+        self._base_offsets = [segment.base_offset for segment in self._segments]
+
+
+class LogTopic(object):
+
+    def __init__(self, path: str, partitions: int, segment_size: int):
+        self._partitions = [
+            LogPartition(os.path.join(path, "partition-{}".format(idx)), segment_size)
+            for idx in range(partitions)
+        ]
+        self._round_robin = count()
+
+    @property
+    def partitions(self) -> List[LogPartition]:
+        return self._partitions
+
+    def get_partition_number(self, key: Optional[AnyStr]) -> int:
+        if key is None:
+            return next(self._round_robin) % len(self._partitions)
+        if isinstance(key, str):
+            key = key.encode("utf-8")
+        return crc32(key) % len(self._partitions)
+
+
+class OffsetStore(object):
+    """
+    Committed offsets of consumer groups, in a file per group. Offset is the next record to read.
+
+    Offsets of the group, locked by this process, are kept in memory. Others are read from disk every time,
+    as they may be committed by another process.
+    """
+
+    FILE_SUFFIX = ".json"
+    LOCK_SUFFIX = ".lock"
+
+    def __init__(self, path: str):
+        """
+        :param path: Directory of the offset files.
+        """
+        os.makedirs(path, exist_ok=True)
+        self._path = path
+        self._offsets = {}
+        self._locks = {}
+        self._changed = set()
+
+    def lock(self, group: str) -> None:
+        """
+        Take the group for consuming by this process.
+
+        :raises ConsumerError: If group is consumed by another process.
+        """
+        if group in self._locks:
+            return
+
+        lock_file = open(self._get_path(group, self.LOCK_SUFFIX), "a")
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise exceptions.ConsumerError("Group '%s' is consumed by another process" % group)
+        self._locks[group] = lock_file
+        self._offsets[group] = self._load(group)
+
+    def get(self, group: str, topic: str, partition: int) -> int:
+        offsets = self._offsets[group] if group in self._offsets else self._load(group)
+        return offsets.get(topic, {}).get(str(partition), 0)
+
+    def commit(self, group: str, topic: str, partition: int, offset: int) -> None:
+        if group not in self._offsets:
+            self._offsets[group] = self._load(group)
+        self._offsets[group].setdefault(topic, {})[str(partition)] = offset
+        self._changed.add(group)
+
+    def flush(self) -> None:
+        for group in self._changed:
+            path = self._get_path(group, self.FILE_SUFFIX)
+            tmp_path = "{}.tmp".format(path)
+            with open(tmp_path, "w") as f:
+                json.dump(self._offsets[group], f)
+            os.replace(tmp_path, path)
+        self._changed.clear()
+
+    def close(self) -> None:
+        self.flush()
+        for lock_file in self._locks.values():
+            lock_file.close()
+        self._locks.clear()
+        self._offsets.clear()
+
+    def _load(self, group: str) -> dict:
+        path = self._get_path(group, self.FILE_SUFFIX)
+        if not os.path.isfile(path):
+            return {}
+        with open(path, "r") as f:
+            return json.load(f)
+
+    def _get_path(self, group: str, suffix: str) -> str:
+        return os.path.join(self._path, quote(group, safe="") + suffix)
+
+
+class FileLogTransport(AbstractTransport):
+
+    DEFAULT_PARTITIONS = 4
+    DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+    DEFAULT_POLL_SECS = 0.5
+    DEFAULT_COMMIT_INTERVAL_SECS = 1
+    READ_BATCH_SIZE = 500
+    # Records in flight per partition, for every message the subscriber handles at once
+    WINDOW_PER_SLOT = 2
+    OFFSETS_DIRNAME = "offsets"
+    CLOSE_TIMEOUT_SECS = 10
+
+    def __init__(
+            self,
+            path: str,
+            partitions: int = DEFAULT_PARTITIONS,
+            segment_size: int = DEFAULT_SEGMENT_SIZE,
+            poll_secs: float = DEFAULT_POLL_SECS,
+            commit_interval_secs: float = DEFAULT_COMMIT_INTERVAL_SECS,
+            max_in_flight: int = Dispatcher.DEFAULT_MAX_IN_FLIGHT,
+            serializer: str = DEFAULT_CONTENT_TYPE,
+            retry_failed: bool = False,
+            **kwargs):
+        """
+        :param path: Directory of the log.
+        :param partitions: Number of partitions for every topic.
+        :param segment_size: Size of the segment file in bytes. New segment is started when current one is full.
+        :param poll_secs: How often readers check for records, appended by other processes.
+            Records of this process are picked up right away.
+        :param commit_interval_secs: How often committed offsets are saved to disk.
+        :param max_in_flight: How many messages each subscriber may handle simultaneously by default.
+        :param serializer: Content type of the records. Records keep no metadata, so all writers and readers
+            of the log must use the same one.
+        :param retry_failed: Handle message, failed in subscriber, again after ``poll_secs``,
+            instead of skipping it. Its partition stalls, until message succeeds.
+        """
+        self._path = path
+        self._partitions = partitions
+        self._segment_size = segment_size
+        self._poll_secs = poll_secs
+        self._commit_interval_secs = commit_interval_secs
+        self._serializer = get_serializer(serializer)
+        self._retry_failed = retry_failed
+        self._dispatcher = Dispatcher(max_in_flight=max_in_flight)
+        self._connected = False
+        self._topics = {}
+        self._offsets = None
+        self._positions = {}
+        self._consumers = {}
+        self._commit_handle = None
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    @property
+    def is_connecting(self) -> bool:
+        return False
+
+    async def connect(self) -> None:
+        if self._connected:
+            return
+        os.makedirs(self._path, exist_ok=True)
+        self._offsets = OffsetStore(os.path.join(self._path, self.OFFSETS_DIRNAME))
+        self._connected = True
+        logger.info("Opened log at '%s'", self._path)
+
+    async def close(self) -> None:
+        for consumer in self._consumers.values():
+            consumer.cancel()
+        self._consumers.clear()
+        await self._dispatcher.join(timeout=self.CLOSE_TIMEOUT_SECS)
+
+        if self._commit_handle is not None:
+            self._commit_handle.cancel()
+            self._commit_handle = None
+        if self._offsets is not None:
+            self._offsets.close()
+        for topic in self._topics.values():
+            for partition in topic.partitions:
+                partition.close()
+        self._topics.clear()
+        self._connected = False
+
+    async def publish(
+            self, data: Transferrable, topic: AnyStr, key: Optional[AnyStr] = None, **kwargs) -> Optional[int]:
+        """
+        Append message to the topic.
+
+        :param key: Messages with the same key always go to the same partition.
+        :return: Offset of the message within its partition.
+        """
+        offsets = await self.publish_many(data, (topic, ), key=key, **kwargs)
+        return offsets[0] if offsets else None
+
+    async def publish_many(
+            self,
+            data: Transferrable,
+            topics: Sequence[AnyStr],
+            key: Optional[AnyStr] = None,
+            **kwargs) -> Optional[List[int]]:
+        if not self._connected:
+            logger.warning("Attempted to send message while not connected")
+            return
+
+        body = self._serializer.serialize_bytes(data)
+
+        offsets = []
+        for topic in topics:
+            log_topic = self._get_topic(topic)
+            partition = log_topic.partitions[log_topic.get_partition_number(key)]
+            offsets.append(partition.append(body))
+        return offsets
+
+    async def consume_queue(self, subscriber: AbstractSubscriber) -> None:
+        """
+        :raises ConsumerError: If the group is already consumed by this or another process.
+        """
+        group = subscriber.name
+        self._offsets.lock(group)
+        for topic in subscriber.requested_topics:
+            for partition_number in range(self._partitions):
+                consumer_key = (group, topic, partition_number)
+                if consumer_key in self._consumers:
+                    raise exceptions.ConsumerError("Group '%s' already consumes '%s'" % (group, topic))
+                self._consumers[consumer_key] = asyncio.ensure_future(
+                    self._consume(subscriber, topic, partition_number))
+            logger.info("Group '%s' is consuming topic '%s'", group, topic)
+
+    def seek(self, group: str, topic: str, offset: int, partition: Optional[int] = None) -> None:
+        """
+        Move consumer group to the given offset, to skip or replay messages.
+        Group must be consumed by this process or not consumed at all.
+
+        :param partition: Partition number. All partitions of the topic, if omitted.
+        """
+        partitions = range(self._partitions) if partition is None else (partition, )
+        for partition_number in partitions:
+            self._positions[(group, topic, partition_number)] = offset
+            self._offsets.commit(group, topic, partition_number, offset)
+        self._offsets.flush()
+
+    def get_offsets(self, group: str, topic: str) -> Dict[int, int]:
+        return {
+            partition_number: self._positions.get(
+                (group, topic, partition_number), self._offsets.get(group, topic, partition_number))
+            for partition_number in range(self._partitions)
+        }
+
+    def _get_topic(self, name: str) -> LogTopic:
+        topic = self._topics.get(name)
+        if topic is None:
+            topic = LogTopic(os.path.join(self._path, name), self._partitions, self._segment_size)
+            self._topics[name] = topic
+        return topic
+
+    async def _consume(self, subscriber: AbstractSubscriber, topic: str, partition_number: int) -> None:
+        position_key = (subscriber.name, topic, partition_number)
+        partition = self._get_topic(topic).partitions[partition_number]
+        self._positions.setdefault(position_key, self._offsets.get(*position_key))
+        window = self._get_window(subscriber)
+        # Dispatched records as ``(offset, body, settled)``, in log order
+        pending = deque()
+        committed = next_offset = self._positions[position_key]
+
+        while True:
+            if self._positions[position_key] != committed:
+                # Moved by ``seek`` meanwhile, records in flight are not committed
+                committed = next_offset = self._positions[position_key]
+                pending.clear()
+
+            while pending and pending[0][2].done():
+                offset, body, settled = pending[0]
+                if not settled.result():
+                    if self._retry_failed:
+                        break
+                    logger.warning("Skipping failed message at offset %s of '%s'", offset, topic)
+                pending.popleft()
+                committed = self._positions[position_key] = offset + 1
+                self._offsets.commit(subscriber.name, topic, partition_number, committed)
+                self._schedule_commit()
+
+            if pending and pending[0][2].done():
+                offset, body, _ = pending.popleft()
+                logger.warning("Message at offset %s of '%s' failed, retrying in %s s", offset, topic, self._poll_secs)
+                await asyncio.sleep(self._poll_secs)
+                if self._positions[position_key] == committed:
+                    pending.appendleft((offset, body, self._dispatch_record(subscriber, topic, offset, body)))
+                continue
+
+            exhausted = True
+            if len(pending) < window:
+                limit = min(window - len(pending), self.READ_BATCH_SIZE)
+                records = partition.read(next_offset, limit)
+                exhausted = len(records) < limit
+                if records and not pending and records[0][0] != committed:
+                    # Position may point before the beginning of the log
+                    committed = self._positions[position_key] = records[0][0]
+                for offset, body in records:
+                    pending.append((offset, body, self._dispatch_record(subscriber, topic, offset, body)))
+                    next_offset = offset + 1
+                if not exhausted and len(pending) < window:
+                    continue
+
+            head = pending[0][2] if pending else None
+            await self._wait_progress(partition, head, exhausted and len(pending) < window)
+
+    def _get_window(self, subscriber: AbstractSubscriber) -> int:
+        in_flight = getattr(subscriber, "MAX_IN_FLIGHT", None) or self._dispatcher.max_in_flight
+        return in_flight * (getattr(subscriber, "BATCH_SIZE", None) or 1) * self.WINDOW_PER_SLOT
+
+    def _dispatch_record(self, subscriber: AbstractSubscriber, topic: str, offset: int, body: bytes) -> asyncio.Future:
+        settled = asyncio.get_event_loop().create_future()
+        message = Message.acquire(LazyBody(body, self._serializer), topic, delivery_tag=offset, received_at=time.time())
+        self._dispatcher.dispatch((subscriber, ), message, topic, partial(self._settle, settled))
+        return settled
+
+    async def _wait_progress(
+            self, partition: LogPartition, settled: Optional[asyncio.Future], wait_records: bool) -> None:
+        """
+        Wait until the oldest dispatched record is settled or, if there is room for them, new records are appended.
+        """
+        waiters = set()
+        if settled is not None:
+            waiters.add(settled)
+        appended = None
+        if wait_records:
+            appended = asyncio.ensure_future(partition.wait(self._poll_secs))
+            waiters.add(appended)
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            if appended is not None and not appended.done():
+                appended.cancel()
+        if appended is not None and appended.done() and not appended.cancelled():
+            partition.refresh()
+
+    async def _settle(self, settled: asyncio.Future, succeeded: bool) -> None:
+        if not settled.done():
+            settled.set_result(succeeded)
+
+    def _schedule_commit(self) -> None:
+        if self._commit_handle is None:
+            self._commit_handle = asyncio.get_event_loop().call_later(self._commit_interval_secs, self._commit)
+
+    def _commit(self) -> None:
+        self._commit_handle = None
+        self._offsets.flush()
+        for topic in self._topics.values():
+            for partition in topic.partitions:
+                partition.flush()
@@ -0,0 +1,145 @@
+"""
+In-process transport. No broker needed, messages never leave the process.
+
+Behaves like topic exchange: every subscriber gets its own bounded queue, bound with subscriber's
+requested topics. Publishing waits when some matched queue is full, so producers can't outrun consumers.
+Latency and publish failures can be simulated for testing purposes.
+
+Usage::
+
+    stream = Stream(transport="sunhead.events.transports.loopback.LoopbackTransport", queue_size=1000)
+"""
+
+import asyncio
+from functools import partial
+import logging
+import random
+import time
+from typing import AnyStr, Sequence
+
+from sunhead.events import exceptions
+from sunhead.events.abc import AbstractTransport, AbstractSubscriber
+from sunhead.events.dispatch import Dispatcher
+from sunhead.events.message import LazyBody, Message
+from sunhead.events.routing import RoutingIndex
+from sunhead.events.types import Transferrable
+from sunhead.serializers import JSONSerializer
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("LoopbackTransport", )
+
+
+class LoopbackTransport(AbstractTransport):
+
+    DEFAULT_QUEUE_SIZE = 10000
+    DEFAULT_PREFETCH = 100
+    CLOSE_TIMEOUT_SECS = 10
+
+    def __init__(
+            self,
+            queue_size: int = DEFAULT_QUEUE_SIZE,
+            prefetch: int = DEFAULT_PREFETCH,
+            max_in_flight: int = Dispatcher.DEFAULT_MAX_IN_FLIGHT,
+            latency_secs: float = 0,
+            failure_rate: float = 0,
+            serialize: bool = False,
+            **kwargs):
+        """
+        :param queue_size: How many messages each queue may hold before publishers have to wait.
+        :param prefetch: How many messages of each queue may be handled at once.
+        :param max_in_flight: How many messages each subscriber may handle simultaneously by default.
+        :param latency_secs: Simulated delay of every publish.
+        :param failure_rate: Probability of simulated publish failure, from 0 to 1.
+        :param serialize: Pass messages through the serializer, as real transports do.
+            Otherwise subscribers receive the very same object, which was published.
+        """
+        self._queue_size = queue_size
+        self._prefetch = prefetch
+        self._latency_secs = latency_secs
+        self._failure_rate = failure_rate
+        self._serializer = JSONSerializer() if serialize else None
+        self._connected = False
+        self._routing = RoutingIndex()
+        self._queues = {}
+        self._consumers = {}
+        self._dispatcher = Dispatcher(max_in_flight=max_in_flight)
+
+    @property
+    def connected(self) -> bool:
+        return self._connected
+
+    @property
+    def is_connecting(self) -> bool:
+        return False
+
+    async def connect(self) -> None:
+        self._connected = True
+
+    async def close(self) -> None:
+        self._stop_consumers()
+        await self._dispatcher.join(timeout=self.CLOSE_TIMEOUT_SECS)
+        self._connected = False
+
+    def drop_connection(self) -> None:
+        """
+        Simulate connection loss. Queues and their messages are kept, consumers are stopped.
+        """
+        logger.warning("Dropping loopback connection")
+        self._stop_consumers()
+        self._connected = False
+        self._notify_disconnected()
+
+    async def publish(self, data: Transferrable, topic: AnyStr, **kwargs) -> None:
+        await self.publish_many(data, (topic, ), **kwargs)
+
+    async def publish_many(self, data: Transferrable, topics: Sequence[AnyStr], **kwargs) -> None:
+        if not self._connected:
+            logger.warning("Attempted to send message while not connected")
+            return
+
+        if self._latency_secs:
+            await asyncio.sleep(self._latency_secs)
+
+        if self._failure_rate and random.random() < self._failure_rate:
+            raise exceptions.PublisherError("Simulated publish failure")
+
+        body = self._serializer.serialize_bytes(data) if self._serializer is not None else data
+        for topic in topics:
+            for queue_name in self._routing.match(topic):
+                await self._queues[queue_name].put((body, topic))
+
+    async def consume_queue(self, subscriber: AbstractSubscriber) -> None:
+        queue_name = subscriber.name
+        if queue_name in self._consumers:
+            raise exceptions.ConsumerError("Queue '%s' already being consumed" % queue_name)
+
+        if queue_name not in self._queues:
+            self._queues[queue_name] = asyncio.Queue(maxsize=self._queue_size)
+
+        for key in subscriber.requested_topics:
+            self._routing.add(key, queue_name)
+
+        logger.info("Consuming queue '%s'", queue_name)
+        self._consumers[queue_name] = asyncio.ensure_future(self._consume(self._queues[queue_name], subscriber))
+
+    async def _consume(self, queue: asyncio.Queue, subscriber: AbstractSubscriber) -> None:
+        prefetch = asyncio.Semaphore(self._prefetch)
+        while True:
+            await prefetch.acquire()
+            body, topic = await queue.get()
+            if self._serializer is not None:
+                body = Message.acquire(LazyBody(body, self._serializer), topic, received_at=time.time())
+            self._dispatcher.dispatch((subscriber, ), body, topic, partial(self._settle, prefetch))
+            # Lets dispatcher reuse the message
+            body = None
+
+    async def _settle(self, prefetch: asyncio.Semaphore, succeeded: bool) -> None:
+        prefetch.release()
+
+    def _stop_consumers(self) -> None:
+        for consumer in self._consumers.values():
+            consumer.cancel()
+        self._consumers.clear()
@@ -1,40 +1,140 @@
+from aiohttp.web import View, Response, StreamResponse, HTTPCreated
 
-from aiohttp.web import View, Response, HTTPCreated
-
-from sunhead.serializers import JSONSerializer
+from sunhead.serializers import get_serializer
 
 
 class BasicView(View):
 
     def basic_response(self, text=None, **kwargs):
+        if isinstance(text, bytes):
+            return Response(body=text, content_type="text/plain", charset="utf-8", **kwargs)
         response = Response(text=text, content_type="text/plain", **kwargs)
         return response
 
 
-class JSONView(BasicView):
+class SerializedView(BasicView):
+    """
+    View, which responds with data, serialized by the serializer of its ``CONTENT_TYPE``.
+    """
 
+    CONTENT_TYPE = "application/json"
     SERIALIZE_KWARGS = {}
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._serializer = JSONSerializer()
+        self._serializer = get_serializer(self.CONTENT_TYPE)
 
-    def json_response(self, context_data=None):
+    def serialized_response(self, context_data=None, **kwargs):
         if context_data is None:
             context_data = {}
 
-        json_data = self._serializer.serialize(context_data, **self.SERIALIZE_KWARGS)
-        response = Response(text=json_data, content_type="application/json")
+        serialized = self._serializer.serialize_bytes(context_data, **self.SERIALIZE_KWARGS)
+        response = Response(body=serialized, content_type=self.CONTENT_TYPE, **kwargs)
 
         return response
 
     def created_response(self, context_data=None, location=None):
         if context_data is not None:
-            context_data = self._serializer.serialize(context_data)
+            context_data = self._serializer.serialize_bytes(context_data)
 
         headers = {
             "Location": location,
         }
 
-        response = Response(text=context_data, status=201, headers=headers)
+        response = Response(body=context_data, status=201, headers=headers, content_type=self.CONTENT_TYPE)
+        return response
+
+
+class JSONView(SerializedView):
+
+    CONTENT_TYPE = "application/json"
+    NDJSON_CONTENT_TYPE = "application/x-ndjson"
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    def json_response(self, context_data=None):
+        return self.serialized_response(context_data)
+
+    async def stream_json_response(self, context_data, ndjson=False, **kwargs):
+        """
+        Send data, encoding it bit by bit, so large payloads are never held in memory as a whole.
+
+        :param context_data: Serializable data. Lists, generators and other iterables (async ones too)
+            are sent item by item as JSON array.
+        :param ndjson: Send items as newline-delimited JSON instead of array.
+        :param kwargs: Passed to ``StreamResponse``.
+        :return: Prepared and finished ``StreamResponse``.
+        """
+        response = StreamResponse(**kwargs)
+        response.content_type = self.NDJSON_CONTENT_TYPE if ndjson else self.CONTENT_TYPE
+        await response.prepare(self.request)
+
+        writer = _ChunkWriter(response, self.STREAM_CHUNK_SIZE)
+        if hasattr(context_data, "__aiter__"):
+            await self._stream_async_items(writer, context_data, ndjson)
+        elif isinstance(context_data, (dict, str, bytes)) or not hasattr(context_data, "__iter__"):
+            await self._stream_chunks(writer, self._serializer.iter_serialize(context_data, **self.SERIALIZE_KWARGS))
+            if ndjson:
+                writer.put("\n")
+        else:
+            await self._stream_items(writer, context_data, ndjson)
+
+        await writer.flush()
+        await response.write_eof()
         return response
+
+    async def _stream_items(self, writer, items, ndjson):
+        writer.put("" if ndjson else "[")
+        for index, item in enumerate(items):
+            await self._stream_item(writer, item, index, ndjson)
+        writer.put("" if ndjson else "]")
+
+    async def _stream_async_items(self, writer, items, ndjson):
+        writer.put("" if ndjson else "[")
+        index = 0
+        async for item in items:
+            await self._stream_item(writer, item, index, ndjson)
+            index += 1
+        writer.put("" if ndjson else "]")
+
+    async def _stream_item(self, writer, item, index, ndjson):
+        if index and not ndjson:
+            writer.put(",")
+        await self._stream_chunks(writer, self._serializer.iter_serialize(item, **self.SERIALIZE_KWARGS))
+        if ndjson:
+            writer.put("\n")
+
+    async def _stream_chunks(self, writer, chunks):
+        for chunk in chunks:
+            if writer.put(chunk):
+                await writer.flush()
+
+
+class _ChunkWriter(object):
+    """
+    Collects small encoded pieces and writes them to response in bigger chunks, waiting for the client
+    to take previous ones.
+    """
+
+    def __init__(self, response, chunk_size):
+        self._response = response
+        self._chunk_size = chunk_size
+        self._buffer = []
+        self._buffered = 0
+
+    def put(self, text):
+        """
+        :return: Whether buffer is full and must be flushed.
+        """
+        self._buffer.append(text)
+        self._buffered += len(text)
+        return self._buffered >= self._chunk_size
+
+    async def flush(self):
+        if not self._buffered:
+            return
+
+        data = "".join(self._buffer).encode("utf-8")
+        self._buffer = []
+        self._buffered = 0
+        self._response.write(data)
+        await self._response.drain()
@@ -1,3 +1,4 @@
 from sunhead.serializers.json import JSONSerializer
+from sunhead.serializers.registry import get_serializer, register_serializer
 
-__all__ = (JSONSerializer, )
\ No newline at end of file
+__all__ = (JSONSerializer, get_serializer, register_serializer)
\ No newline at end of file
@@ -5,6 +5,9 @@ JSON message body serializer
 import logging
 from datetime import datetime, timedelta
 import enum
+from functools import singledispatch
+from operator import attrgetter
+from typing import Callable, Iterator
 import uuid
 
 try:
@@ -12,6 +15,12 @@ try:
 except ImportError:
     import json
 
+try:
+    # Encodes straight to UTF-8 bytes
+    import orjson
+except ImportError:
+    orjson = None
+
 from sunhead.events.abc import AbstractSerializer
 from sunhead.events.exceptions import SerializationError
 from sunhead.events.types import Transferrable, Serialized
@@ -19,11 +28,28 @@ from sunhead.events.types import Transferrable, Serialized
 logger = logging.getLogger(__name__)
 
 
+@singledispatch
+def _serial(obj):
+    raise TypeError("Type not serializable %s in %s" % (type(obj), obj))
+
+
+_serial.register(datetime, datetime.isoformat)
+_serial.register(enum.Enum, attrgetter("value"))
+_serial.register(timedelta, str)
+_serial.register(set, list)
+_serial.register(uuid.UUID, str)
+
+
 class JSONSerializer(AbstractSerializer):
 
+    CONTENT_TYPE = "application/json"
+
     _DEF_SERIALIZED_DEFAULT = "{}"
     _DEF_DESERIALIZED_DEFAULT = {}
 
+    # Converter for every class seen, resolved through its MRO only once
+    _serial_cache = {}
+
     def __init__(self, graceful=False):
         super().__init__(graceful)
         self._graceful = graceful
@@ -34,27 +60,22 @@ class JSONSerializer(AbstractSerializer):
     def json_serial(cls, obj):
         """JSON serializer for objects not serializable by default json code"""
 
-        if isinstance(obj, datetime):
-            serial = obj.isoformat()
-
-        elif issubclass(obj.__class__, enum.Enum):
-            serial = obj.value
-
-        elif isinstance(obj, timedelta):
-            serial = str(obj)
-
-        elif isinstance(obj, set):
-            serial = list(x for x in obj)
+        converter = cls._serial_cache.get(obj.__class__)
+        if converter is None:
+            converter = _serial.dispatch(obj.__class__)
+            cls._serial_cache[obj.__class__] = converter
 
-        elif isinstance(obj, uuid.UUID):
-            serial = str(obj)
+        return converter(obj)
 
-        # FIXME: if you want to add one more custom serializer, think twice about `singledispatch`
-
-        else:
-            raise TypeError("Type not serializable %s in %s" % (type(obj), obj))
+    @classmethod
+    def register_type(cls, type_: type, converter: Callable) -> None:
+        """
+        Make instances of ``type_`` and its subclasses serializable.
 
-        return serial
+        :param converter: Function, which takes the instance and returns something serializable by json.
+        """
+        _serial.register(type_, converter)
+        cls._serial_cache.clear()
 
     @property
     def graceful(self):
@@ -81,6 +102,30 @@ class JSONSerializer(AbstractSerializer):
 
         return serialized
 
+    def serialize_bytes(self, data: Transferrable, **kwargs) -> bytes:
+        """
+        Use ``orjson`` when it is installed and no json options are given. Otherwise serialize to string
+        and encode it, which is a plain copy of the buffer, as output is ASCII unless ``ensure_ascii`` is off.
+        """
+        if orjson is not None and not kwargs:
+            try:
+                # Dates and dataclasses are left to our converters, so output is the same as the standard one's
+                option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+                return orjson.dumps(data, default=self.json_serial, option=option)
+            except orjson.JSONEncodeError:
+                # E.g. integer, too big for orjson. Standard encoder will either manage or report it
+                pass
+
+        return self.serialize(data, **kwargs).encode("utf-8")
+
+    def iter_serialize(self, data: Transferrable, **kwargs) -> Iterator[str]:
+        """
+        Encode data bit by bit, without building the whole string in memory.
+        Errors can't be handled gracefully here, because part of the result is already out.
+        """
+        kwargs.setdefault("default", self.json_serial)
+        return json.JSONEncoder(**kwargs).iterencode(data)
+
     def deserialize(self, msg: Serialized) -> Transferrable:
         body_txt = msg.decode("utf-8") if hasattr(msg, "decode") else msg
         try:
@@ -0,0 +1,77 @@
+"""
+MessagePack message body serializer. Compact binary alternative to JSON.
+
+Requires ``msgpack`` package, install it with ``pip install sunhead[msgpack]``.
+"""
+
+import logging
+
+from sunhead.events.abc import AbstractSerializer
+from sunhead.events.exceptions import SerializationError
+from sunhead.events.types import Transferrable, Serialized
+from sunhead.serializers.json import JSONSerializer
+
+logger = logging.getLogger(__name__)
+
+
+class MsgPackSerializer(AbstractSerializer):
+
+    CONTENT_TYPE = "application/msgpack"
+
+    _DEF_SERIALIZED_DEFAULT = b"\x80"
+    _DEF_DESERIALIZED_DEFAULT = {}
+
+    def __init__(self, graceful=False):
+        super().__init__(graceful)
+        try:
+            import msgpack
+        except ImportError:
+            logger.error("MsgPackSerializer requires `msgpack` package")
+            raise
+        self._msgpack = msgpack
+        self._graceful = graceful
+        self._serialized_default = self._DEF_SERIALIZED_DEFAULT
+        self._deserialized_default = self._DEF_DESERIALIZED_DEFAULT
+
+    @property
+    def graceful(self):
+        return self._graceful
+
+    @graceful.setter
+    def graceful(self, value):
+        self._graceful = value
+
+    def set_defaults(self, serialized, unserialized):
+        self._serialized_default = serialized
+        self._deserialized_default = unserialized
+
+    def serialize(self, data: Transferrable, **kwargs) -> Serialized:
+        # Types, unknown to msgpack, are converted the same way JSON does it
+        kwargs.setdefault("default", JSONSerializer.json_serial)
+        kwargs.setdefault("use_bin_type", True)
+        try:
+            serialized = self._msgpack.packb(data, **kwargs)
+        except Exception:
+            logger.error("Message serialization error", exc_info=True)
+            if not self.graceful:
+                raise SerializationError
+
+            serialized = self._serialized_default
+
+        return serialized
+
+    def serialize_bytes(self, data: Transferrable, **kwargs) -> bytes:
+        return self.serialize(data, **kwargs)
+
+    def deserialize(self, msg: Serialized) -> Transferrable:
+        body = msg.encode("utf-8") if isinstance(msg, str) else msg
+        try:
+            deserialized = self._msgpack.unpackb(body, raw=False)
+        except Exception:
+            logger.error("Error deserializing message body", exc_info=True)
+            if not self.graceful:
+                raise SerializationError
+
+            deserialized = self._deserialized_default
+
+        return deserialized
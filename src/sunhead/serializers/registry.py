@@ -0,0 +1,47 @@
+"""
+Serializers by content type.
+
+Serializer classes are registered by dotted path, so optional ones are imported only when requested.
+"""
+
+import logging
+
+from sunhead.events.abc import AbstractSerializer
+from sunhead.utils import get_class_by_path
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("DEFAULT_CONTENT_TYPE", "register_serializer", "get_serializer", "get_serializer_class")
+
+
+DEFAULT_CONTENT_TYPE = "application/json"
+
+_serializers = {
+    "application/json": "sunhead.serializers.json.JSONSerializer",
+    "application/msgpack": "sunhead.serializers.msgpack.MsgPackSerializer",
+}
+
+
+def register_serializer(content_type: str, class_path: str) -> None:
+    """
+    :param content_type: Content type, which messages and responses will be marked with.
+    :param class_path: Dotted path to the ``AbstractSerializer`` subclass.
+    """
+    _serializers[content_type] = class_path
+
+
+def get_serializer_class(content_type: str = DEFAULT_CONTENT_TYPE) -> type:
+    """
+    :param content_type: Content type, parameters like ``; charset=utf-8`` are ignored.
+    """
+    try:
+        class_path = _serializers[content_type.split(";", 1)[0].strip().lower()]
+    except KeyError:
+        raise LookupError("No serializer for content type '%s'" % content_type)
+
+    return get_class_by_path(class_path)
+
+
+def get_serializer(content_type: str = DEFAULT_CONTENT_TYPE, **kwargs) -> AbstractSerializer:
+    return get_serializer_class(content_type)(**kwargs)
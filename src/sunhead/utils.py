@@ -4,6 +4,7 @@ Helper utilities that everyone needs.
 
 import asyncio
 from collections import namedtuple, OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
 from datetime import datetime
 from enum import Enum
 import importlib
@@ -142,3 +143,22 @@ def choices_from_enum(source: Enum) -> Tuple[Tuple[Any, str], ...]:
     """
     result = tuple((s.value, s.name.title()) for s in source)
     return result
+
+
+EXECUTOR_THREAD = "thread"
+EXECUTOR_PROCESS = "process"
+
+
+def make_executor(kind: str = EXECUTOR_THREAD, max_workers: Optional[int] = None) -> Executor:
+    """
+    Make pool to run blocking or CPU-heavy work off the event loop.
+
+    :param kind: ``thread`` or ``process``. Process pool needs picklable functions and arguments.
+    :param max_workers: Size of the pool. Default of the ``concurrent.futures`` is used if omitted.
+    :return: Executor ready to be passed to ``loop.run_in_executor()``.
+    """
+    if kind == EXECUTOR_THREAD:
+        return ThreadPoolExecutor(max_workers=max_workers)
+    if kind == EXECUTOR_PROCESS:
+        return ProcessPoolExecutor(max_workers=max_workers)
+    raise ValueError("Unknown executor kind '%s'" % kind)
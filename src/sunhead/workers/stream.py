@@ -53,6 +53,9 @@ class StreamWorker(StreamConnectionMixin, AbstractStreamWorker):
         except KeyboardInterrupt:
             logger.info("KeyboardInterrupt caught")
         finally:
+            # Let subscribers finish collected batches and in-flight messages
+            if self._stream is not None:
+                loop.run_until_complete(self._stream.close())
             loop.stop()
 
         logger.info("Worker stopped.")
@@ -0,0 +1,251 @@
+"""
+Runs several stream worker processes, so CPU-bound subscribers can use all the cores.
+
+Every process makes its own Stream connection and subscribes to the same queues, so the broker spreads
+messages among them. Crashed processes are restarted. Each process periodically writes its metrics
+snapshot to the metrics directory, supervisor merges them into one file with ``worker`` label on every
+sample, ready for the Prometheus textfile collector.
+"""
+
+from collections import OrderedDict
+from itertools import chain
+import logging
+import os
+import re
+import signal
+import time
+from typing import Optional
+
+from sunhead.metrics import get_metrics, Metrics
+from sunhead.periodical import crontab
+from sunhead.utils import get_class_by_path
+
+
+logger = logging.getLogger(__name__)
+
+
+__all__ = ("Supervisor", )
+
+
+WORKER_INDEX_ENVVAR = "SUNHEAD_WORKER_INDEX"
+
+_SAMPLE_RE = re.compile(r"^(?P<name>[^\s{]+)(?:{(?P<labels>.*)})?(?P<rest>\s.*)$")
+
+
+class Supervisor(object):
+
+    POLL_SECS = 0.5
+    RESTART_DELAY_SECS = 1
+    MAX_RESTART_DELAY_SECS = 60
+    # Worker, which lived that long, is considered healthy and its restart delay starts over
+    HEALTHY_UPTIME_SECS = 60
+    STOP_TIMEOUT_SECS = 30
+    DEFAULT_METRICS_INTERVAL_SECS = 15
+    METRICS_FILE_NAME = "stream_workers.prom"
+
+    def __init__(
+            self,
+            worker_class_name: str,
+            processes: Optional[int] = None,
+            metrics_dir: Optional[str] = None,
+            metrics_interval_secs: int = DEFAULT_METRICS_INTERVAL_SECS):
+        """
+        :param worker_class_name: Dotted path to the ``StreamWorker`` subclass.
+        :param processes: How many worker processes to run. Number of CPUs if omitted.
+        :param metrics_dir: Directory for metrics snapshots. Metrics are not collected if omitted.
+        :param metrics_interval_secs: How often workers write their metrics snapshots.
+        """
+        self._worker_class_name = worker_class_name
+        self._processes = processes or os.cpu_count() or 1
+        self._metrics_dir = metrics_dir
+        self._metrics_interval_secs = metrics_interval_secs
+        self._workers = {}
+        self._started_at = {}
+        self._restart_delays = {}
+        self._restart_at = {}
+        self._stopping = False
+        self._stop_deadline = None
+        self._metrics_merged_at = 0
+
+    def run(self) -> None:
+        signal.signal(signal.SIGINT, self._on_stop_signal)
+        signal.signal(signal.SIGTERM, self._on_stop_signal)
+
+        logger.info("Starting %s workers of '%s'", self._processes, self._worker_class_name)
+        while self._workers or not self._stopping:
+            self._reap()
+            if self._stopping:
+                self._kill_overdue()
+            else:
+                self._spawn_missing()
+            self._merge_metrics()
+            time.sleep(self.POLL_SECS)
+
+        logger.info("All workers stopped.")
+
+    def _on_stop_signal(self, signum, frame) -> None:
+        if self._stopping:
+            return
+
+        logger.info("Stopping workers...")
+        self._stopping = True
+        self._stop_deadline = time.monotonic() + self.STOP_TIMEOUT_SECS
+        for pid in self._workers:
+            self._signal_worker(pid, signal.SIGTERM)
+
+    def _spawn_missing(self) -> None:
+        running = set(self._workers.values())
+        now = time.monotonic()
+        for index in range(self._processes):
+            if index in running or self._restart_at.get(index, 0) > now:
+                continue
+            self._spawn(index)
+
+    def _spawn(self, index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                self._run_worker(index)
+            except KeyboardInterrupt:
+                pass
+            except BaseException:
+                logger.error("Worker %s failed", index, exc_info=True)
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+
+        logger.info("Started worker %s (pid %s)", index, pid)
+        self._workers[pid] = index
+        self._started_at[index] = time.monotonic()
+
+    def _run_worker(self, index: int) -> None:
+        signal.signal(signal.SIGINT, _on_worker_stop_signal)
+        signal.signal(signal.SIGTERM, _on_worker_stop_signal)
+        os.environ[WORKER_INDEX_ENVVAR] = str(index)
+
+        worker = get_class_by_path(self._worker_class_name)()
+        if self._metrics_dir is not None:
+            crontab(
+                "* * * * * */{}".format(self._metrics_interval_secs),
+                func=_write_metrics_snapshot,
+                args=(self._get_snapshot_path(index), ),
+                start=True,
+            )
+        worker.run()
+
+    def _reap(self) -> None:
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self._workers.clear()
+                return
+            if not pid:
+                return
+
+            index = self._workers.pop(pid, None)
+            if index is None:
+                continue
+
+            if self._stopping:
+                logger.info("Worker %s (pid %s) stopped", index, pid)
+                continue
+
+            self._schedule_restart(index, status)
+
+    def _schedule_restart(self, index: int, status: int) -> None:
+        uptime = time.monotonic() - self._started_at.get(index, 0)
+        if uptime >= self.HEALTHY_UPTIME_SECS:
+            delay = self.RESTART_DELAY_SECS
+        else:
+            delay = min(self._restart_delays.get(index, 0) * 2 or self.RESTART_DELAY_SECS,
+                        self.MAX_RESTART_DELAY_SECS)
+        self._restart_delays[index] = delay
+        self._restart_at[index] = time.monotonic() + delay
+        logger.error("Worker %s exited unexpectedly (status %s), restarting in %s s", index, status, delay)
+
+    def _kill_overdue(self) -> None:
+        if time.monotonic() < self._stop_deadline:
+            return
+        for pid, index in self._workers.items():
+            logger.warning("Worker %s (pid %s) didn't stop in time, killing it", index, pid)
+            self._signal_worker(pid, signal.SIGKILL)
+
+    def _signal_worker(self, pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _get_snapshot_path(self, index: int) -> str:
+        return os.path.join(self._metrics_dir, "worker-{}.prom.part".format(index))
+
+    def _merge_metrics(self) -> None:
+        if self._metrics_dir is None:
+            return
+
+        now = time.monotonic()
+        if now - self._metrics_merged_at < self._metrics_interval_secs:
+            return
+        self._metrics_merged_at = now
+
+        families = OrderedDict()
+        for index in range(self._processes):
+            try:
+                with open(self._get_snapshot_path(index), "r") as f:
+                    snapshot = f.read()
+            except FileNotFoundError:
+                continue
+            _merge_snapshot(families, snapshot, index)
+
+        merged = "".join(
+            "".join(line + "\n" for line in chain(family["meta"].values(), family["samples"]))
+            for family in families.values()
+        )
+        _write_atomically(os.path.join(self._metrics_dir, self.METRICS_FILE_NAME), merged)
+
+
+def _on_worker_stop_signal(signum, frame) -> None:
+    # Worker stops gracefully on the first signal. Others are ignored, so they don't interrupt its cleanup.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def _write_metrics_snapshot(path: str) -> None:
+    try:
+        _write_atomically(path, get_metrics().text_snapshot(Metrics.SNAPSHOT_PROMETHEUS))
+    except Exception:
+        logger.warning("Can't write metrics snapshot", exc_info=True)
+
+
+def _write_atomically(path: str, text: str) -> None:
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def _merge_snapshot(families: OrderedDict, snapshot: str, index: int) -> None:
+    """
+    Add samples of the worker snapshot to the families, labelled with worker index.
+    HELP and TYPE lines are taken from the first snapshot, which has the family.
+    """
+    family = None
+    for line in snapshot.splitlines():
+        if line.startswith("#"):
+            parts = line.split(None, 3)
+            if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                family = families.setdefault(parts[2], {"meta": OrderedDict(), "samples": []})
+                family["meta"].setdefault(parts[1], line)
+            continue
+
+        match = _SAMPLE_RE.match(line)
+        if match is None or family is None:
+            continue
+
+        labels = 'worker="{}"'.format(index)
+        if match.group("labels"):
+            labels = "{},{}".format(match.group("labels"), labels)
+        family["samples"].append("{}{{{}}}{}".format(match.group("name"), labels, match.group("rest")))